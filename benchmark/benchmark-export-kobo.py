@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2013-2017 Alberto Pettarin (alberto@albertopettarin.it)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Benchmark export-kobo.py on a (synthetic) KoboReader.sqlite file,
+reporting wall time, throughput (Bookmark rows in the SQLite file per second),
+and peak memory for each export mode.
+
+Each mode runs in a separate process,
+so that its peak memory is measured in isolation.
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+import argparse
+import io
+import json
+import os
+import runpy
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SCRIPT = os.path.join(BENCHMARK_DIR, os.pardir, u"export-kobo.py")
+
+GENERATOR = os.path.join(BENCHMARK_DIR, u"generate-kobo-db.py")
+
+# NOTE: the placeholder BOOK is replaced with the title of a book in the SQLite file
+MODES = [
+    (u"human", []),
+    (u"csv", [u"--csv"]),
+    (u"kindle", [u"--kindle"]),
+    (u"raw", [u"--raw"]),
+    (u"list", [u"--list"]),
+    (u"bookid", [u"--bookid", u"1"]),
+    (u"book", [u"--book", u"BOOK"]),
+]
+
+
+def run_child(script, result_path, args):
+    """
+    Run export-kobo.py in this process, with the given arguments,
+    discarding its standard output,
+    and write its wall time and peak memory to the given JSON file.
+    """
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    sys.argv = [script] + args
+    # NOTE: as when running the script directly,
+    #       its directory must be in the module search path
+    sys.path.insert(0, os.path.dirname(script))
+    start = time.time()
+    code = 0
+    try:
+        runpy.run_path(script, run_name="__main__")
+    except SystemExit as exc:
+        code = exc.code
+    elapsed = time.time() - start
+    sys.stdout.flush()
+    peak = None
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform != "darwin":
+            # Linux reports KiB, macOS bytes
+            peak *= 1024
+    with io.open(result_path, "w", encoding="utf-8") as f:
+        f.write(u"%s" % json.dumps({"seconds": elapsed, "peak_bytes": peak, "exit_code": code}))
+
+
+def run_mode(db_path, args, repeat):
+    """
+    Run export-kobo.py with the given arguments ``repeat`` times,
+    each in a new process, and return the best result.
+    """
+    best = None
+    handle, result_path = tempfile.mkstemp(suffix=u".json")
+    os.close(handle)
+    try:
+        for i in range(repeat):
+            subprocess.check_call([sys.executable, os.path.abspath(__file__), u"--child", result_path, db_path] + args)
+            with io.open(result_path, "r", encoding="utf-8") as f:
+                result = json.load(f)
+            if result["exit_code"] not in [0, None]:
+                raise RuntimeError(u"export-kobo.py %s exited with code %s" % (u" ".join(args), result["exit_code"]))
+            if (best is None) or (result["seconds"] < best["seconds"]):
+                best = result
+    finally:
+        os.remove(result_path)
+    return best
+
+
+def main():
+    if (len(sys.argv) > 2) and (sys.argv[1] == u"--child"):
+        run_child(os.path.abspath(SCRIPT), sys.argv[2], sys.argv[3:])
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(
+        prog=u"benchmark-export-kobo",
+        description=u"Benchmark export-kobo.py on a synthetic KoboReader.sqlite file."
+    )
+    parser.add_argument("--db", type=str, default=None, help="Use the given SQLite file instead of generating one")
+    parser.add_argument("--books", type=int, default=200, help="Number of books of the generated SQLite file (default: 200)")
+    parser.add_argument("--bookmarks", type=int, default=250, help="Number of bookmarks per book of the generated SQLite file (default: 250)")
+    parser.add_argument("--text-length", type=int, default=200, help="Average length of highlighted texts of the generated SQLite file (default: 200)")
+    parser.add_argument("--repeat", type=int, default=3, help="Run each mode the given number of times, and keep the best (default: 3)")
+    parser.add_argument("--modes", type=str, default=None, help="Comma-separated list of modes to run (default: all)")
+    parser.add_argument("--json", type=str, default=None, help="Write the results to the given JSON file")
+    parser.add_argument("--baseline", type=str, default=None, help="Compare the results with the given JSON file, written by a previous run with --json")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Fail if a mode is slower or uses more memory than the baseline by more than this fraction (default: 0.25)")
+    vargs = vars(parser.parse_args())
+
+    temp_dir = None
+    db_path = vargs["db"]
+    if db_path is None:
+        temp_dir = tempfile.mkdtemp()
+        db_path = os.path.join(temp_dir, u"KoboReader.sqlite")
+        subprocess.check_call([
+            sys.executable, GENERATOR, db_path,
+            u"--books", u"%d" % vargs["books"],
+            u"--bookmarks", u"%d" % vargs["bookmarks"],
+            u"--text-length", u"%d" % vargs["text_length"],
+        ])
+
+    try:
+        sql_connection = sqlite3.connect(db_path)
+        rows = sql_connection.execute(u"SELECT COUNT(*) FROM Bookmark;").fetchone()[0]
+        title = sql_connection.execute(
+            u"SELECT content.Title FROM Bookmark INNER JOIN content ON Bookmark.VolumeID = content.ContentID LIMIT 1;"
+        ).fetchone()[0]
+        sql_connection.close()
+
+        modes = MODES
+        if vargs["modes"] is not None:
+            selected = vargs["modes"].split(u",")
+            modes = [(n, a) for (n, a) in MODES if n in selected]
+
+        results = {}
+        print(u"%-8s %10s %14s %12s" % (u"mode", u"seconds", u"rows/s", u"peak MiB"))
+        for (name, args) in modes:
+            args = [(title if a == u"BOOK" else a) for a in args]
+            result = run_mode(db_path, args, vargs["repeat"])
+            result["rows"] = rows
+            result["rows_per_second"] = rows / result["seconds"] if result["seconds"] > 0 else None
+            results[name] = result
+            peak = (u"%12.1f" % (result["peak_bytes"] / 1048576.0)) if result["peak_bytes"] is not None else u"%12s" % u"n/a"
+            print(u"%-8s %10.3f %14.0f %s" % (name, result["seconds"], result["rows_per_second"] or 0, peak))
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir)
+
+    if vargs["json"] is not None:
+        with io.open(vargs["json"], "w", encoding="utf-8") as f:
+            f.write(u"%s" % json.dumps(results, indent=2, sort_keys=True))
+
+    if vargs["baseline"] is not None:
+        with io.open(vargs["baseline"], "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = []
+        limit = 1.0 + vargs["tolerance"]
+        for name in sorted(results):
+            if name not in baseline:
+                continue
+            if results[name]["seconds"] > baseline[name]["seconds"] * limit:
+                regressions.append(u"%s: %.3f s vs %.3f s" % (name, results[name]["seconds"], baseline[name]["seconds"]))
+            if (results[name]["peak_bytes"] is not None) and (baseline[name]["peak_bytes"] is not None):
+                if results[name]["peak_bytes"] > baseline[name]["peak_bytes"] * limit:
+                    regressions.append(u"%s: %d bytes vs %d bytes" % (name, results[name]["peak_bytes"], baseline[name]["peak_bytes"]))
+        if len(regressions) > 0:
+            for regression in regressions:
+                print(u"REGRESSION: %s" % regression, file=sys.stderr)
+            sys.exit(1)
+
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
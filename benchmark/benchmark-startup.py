@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2013-2017 Alberto Pettarin (alberto@albertopettarin.it)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Benchmark the startup of export-kobo.py, that is,
+the time spent importing modules, as reported by ``python -X importtime``,
+on a small (synthetic) KoboReader.sqlite file.
+
+Fail if the import time of any mode exceeds the given budget,
+or if a mode imports a module it should not need,
+e.g. ``multiprocessing`` for a simple ``--list``.
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+import argparse
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SCRIPT = os.path.join(BENCHMARK_DIR, os.pardir, u"export-kobo.py")
+
+GENERATOR = os.path.join(BENCHMARK_DIR, u"generate-kobo-db.py")
+
+# the main module of export-kobo.py, imported by the script
+MAIN_MODULE = u"export_kobo_cli"
+
+# modules that only some modes need
+LAZY_MODULES = [
+    u"csv",
+    u"glob",
+    u"hashlib",
+    u"json",
+    u"multiprocessing",
+    u"pyarrow",
+    u"urllib.request",
+]
+
+# NOTE: each mode lists the lazy modules it is allowed to import
+MODES = [
+    (u"list", [u"--list"], []),
+    (u"human", [], []),
+    (u"raw", [u"--raw"], []),
+    (u"kindle", [u"--kindle"], []),
+    (u"csv", [u"--csv"], [u"csv"]),
+    (u"json", [u"--json"], [u"json"]),
+]
+
+
+def parse_importtime(stderr):
+    """
+    Parse the ``-X importtime`` report in the given string,
+    returning a pair ``(microseconds, modules)``,
+    where ``microseconds`` is the cumulative import time
+    of the modules imported by export-kobo.py,
+    i.e., not by the Python startup,
+    and ``modules`` is the list of their names.
+    """
+    total = 0
+    modules = []
+    started = False
+    for line in stderr.splitlines():
+        if not line.startswith(u"import time:"):
+            continue
+        fields = line[len(u"import time:"):].split(u"|")
+        if (len(fields) != 3) or (not fields[1].strip().isdigit()):
+            # header line
+            continue
+        name = fields[2].rstrip()
+        top_level = not name.startswith(u"  ")
+        name = name.strip()
+        if name == MAIN_MODULE:
+            started = True
+        if not started:
+            continue
+        modules.append(name)
+        if top_level:
+            total += int(fields[1])
+    return (total, modules)
+
+
+def run_mode(db_path, args, repeat):
+    """
+    Run export-kobo.py with the given arguments ``repeat`` times,
+    each in a new process, and return the best result.
+    """
+    # NOTE: make sure that bytecode is cached, as in a normal run
+    env = dict(os.environ)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    command = [sys.executable, u"-X", u"importtime", os.path.abspath(SCRIPT), db_path] + args
+    subprocess.check_call(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        stderr = process.communicate()[1].decode("utf-8", "replace")
+        elapsed = time.time() - start
+        if process.returncode != 0:
+            raise RuntimeError(u"export-kobo.py %s exited with code %s" % (u" ".join(args), process.returncode))
+        microseconds, modules = parse_importtime(stderr)
+        result = {
+            "import_ms": microseconds / 1000.0,
+            "seconds": elapsed,
+            "modules": modules,
+        }
+        if (best is None) or (result["import_ms"] < best["import_ms"]):
+            best = result
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog=u"benchmark-startup",
+        description=u"Benchmark the startup (import time) of export-kobo.py."
+    )
+    parser.add_argument("--db", type=str, default=None, help="Use the given SQLite file instead of generating one")
+    parser.add_argument("--repeat", type=int, default=5, help="Run each mode the given number of times, and keep the best (default: 5)")
+    parser.add_argument("--modes", type=str, default=None, help="Comma-separated list of modes to run (default: all)")
+    parser.add_argument("--budget", type=float, default=50.0, help="Fail if the import time of a mode exceeds the given number of milliseconds (default: 50)")
+    parser.add_argument("--json", type=str, default=None, help="Write the results to the given JSON file")
+    vargs = vars(parser.parse_args())
+
+    temp_dir = None
+    db_path = vargs["db"]
+    if db_path is None:
+        temp_dir = tempfile.mkdtemp()
+        db_path = os.path.join(temp_dir, u"KoboReader.sqlite")
+        subprocess.check_call([sys.executable, GENERATOR, db_path, u"--books", u"5", u"--bookmarks", u"5"])
+
+    try:
+        modes = MODES
+        if vargs["modes"] is not None:
+            selected = vargs["modes"].split(u",")
+            modes = [(n, a, l) for (n, a, l) in MODES if n in selected]
+
+        results = {}
+        failures = []
+        print(u"%-8s %10s %10s" % (u"mode", u"import ms", u"wall ms"))
+        for (name, args, allowed) in modes:
+            result = run_mode(db_path, args, vargs["repeat"])
+            results[name] = result
+            print(u"%-8s %10.1f %10.1f" % (name, result["import_ms"], result["seconds"] * 1000.0))
+            if result["import_ms"] > vargs["budget"]:
+                failures.append(u"%s: %.1f ms of imports, budget %.1f ms" % (name, result["import_ms"], vargs["budget"]))
+            for module in LAZY_MODULES:
+                if (module in result["modules"]) and (module not in allowed):
+                    failures.append(u"%s: imports %s" % (name, module))
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir)
+
+    if vargs["json"] is not None:
+        with io.open(vargs["json"], "w", encoding="utf-8") as f:
+            f.write(u"%s" % json.dumps(results, indent=2, sort_keys=True))
+
+    if len(failures) > 0:
+        for failure in failures:
+            print(u"FAILURE: %s" % failure, file=sys.stderr)
+        sys.exit(1)
+
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2013-2017 Alberto Pettarin (alberto@albertopettarin.it)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Check that, when several output formats are requested,
+export-kobo.py exports in the one that takes precedence
+(for example, ``--kindle --csv`` exports in Kindle My Clippings format),
+as documented in ``ExportKobo.output_format()``.
+
+Fail if a combination of formats exits with an error,
+or if its output differs from the one of the format that takes precedence.
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+import argparse
+import itertools
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SCRIPT = os.path.join(BENCHMARK_DIR, os.pardir, u"export-kobo.py")
+
+GENERATOR = os.path.join(BENCHMARK_DIR, u"generate-kobo-db.py")
+
+# NOTE: in order of precedence, see ExportKobo.output_format();
+#       --parquet and --arrow are not checked,
+#       as they need pyarrow and write binary files
+FORMATS = [u"--kindle", u"--csv", u"--json", u"--ndjson", u"--raw"]
+
+# NOTE: the modes that support only some of the formats
+LISTING_FORMATS = [u"--csv", u"--json", u"--ndjson"]
+
+
+def export(db_path, args):
+    """
+    Run export-kobo.py on the given SQLite file with the given arguments,
+    and return the pair (exit code, output).
+    """
+    process = subprocess.Popen([sys.executable, SCRIPT, db_path] + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = process.communicate()
+    return (process.returncode, stdout)
+
+
+def check_mode(db_path, mode, formats):
+    """
+    Check each pair of the given formats in the given mode,
+    returning a list of failure messages.
+    """
+    failures = []
+    for (first, second) in itertools.combinations(formats, 2):
+        expected = export(db_path, mode + [first])
+        for args in [[first, second], [second, first]]:
+            actual = export(db_path, mode + args)
+            name = u" ".join(mode + args)
+            if actual[0] != 0:
+                failures.append(u"%s: exit code %d" % (name, actual[0]))
+            elif actual != expected:
+                failures.append(u"%s: output differs from %s" % (name, u" ".join(mode + [first])))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog=u"check-formats",
+        description=u"Check the precedence of the output formats of export-kobo.py."
+    )
+    parser.add_argument("--books", type=int, default=3, help="Number of books of the generated database (default: 3)")
+    vargs = vars(parser.parse_args())
+
+    failures = []
+    temp_dir = tempfile.mkdtemp()
+    try:
+        db_path = os.path.join(temp_dir, u"KoboReader.sqlite")
+        subprocess.check_call([sys.executable, GENERATOR, db_path, u"--books", str(vargs["books"]), u"--bookmarks", u"5"])
+        for (mode, formats) in [([], FORMATS), ([u"--list"], LISTING_FORMATS), ([u"--stats"], LISTING_FORMATS)]:
+            mode_failures = check_mode(db_path, mode, formats)
+            print(u"%-10s %s" % (u" ".join(mode) or u"(items)", u"FAIL" if len(mode_failures) > 0 else u"OK"))
+            failures.extend(mode_failures)
+    finally:
+        shutil.rmtree(temp_dir)
+
+    if len(failures) > 0:
+        for failure in failures:
+            print(u"FAILURE: %s" % failure, file=sys.stderr)
+        sys.exit(1)
+
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2013-2017 Alberto Pettarin (alberto@albertopettarin.it)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Check that repeated incremental exports (``--incremental``)
+append only the new items, for each generation of the schema
+of synthetic KoboReader.sqlite files, including the old firmwares
+whose Bookmark table lacks the DateModified column,
+and the databases whose dates are all NULL.
+
+Fail if a run appends items already exported by a previous run,
+or if it misses a new item.
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+import argparse
+import io
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SCRIPT = os.path.join(BENCHMARK_DIR, os.pardir, u"export-kobo.py")
+
+GENERATOR = os.path.join(BENCHMARK_DIR, u"generate-kobo-db.py")
+
+# NOTE: each schema is a pair (name, arguments of the generator)
+SCHEMAS = [
+    (u"current", []),
+    (u"old", [u"--old-schema"]),
+    (u"null-dates", [u"--null-date-ratio", u"1"]),
+    (u"no-datemodified", [u"--no-datemodified"]),
+    (u"old-no-datemodified", [u"--old-schema", u"--no-datemodified"]),
+]
+
+# NOTE: a copy of the first row, with a new BookmarkID,
+#       and a DateModified newer than the others, if the column exists
+INSERT_COPY = [
+    u"CREATE TEMP TABLE Copy AS SELECT * FROM Bookmark WHERE rowid = 1;",
+    u"UPDATE Copy SET BookmarkID = 'check-incremental-new';",
+    u"INSERT INTO Bookmark SELECT * FROM Copy;",
+]
+
+UPDATE_DATEMODIFIED = u"UPDATE Bookmark SET DateModified = '2100-01-01T00:00:00.000' WHERE BookmarkID = 'check-incremental-new';"
+
+
+def count_lines(path):
+    """
+    Return the number of lines of the given file (one per NDJSON item).
+    """
+    with io.open(path, "r", encoding="utf-8") as f:
+        return len([line for line in f if line.strip()])
+
+
+def export(db_path, state_path, output_path):
+    """
+    Run an incremental NDJSON export of the given SQLite file,
+    and return the number of items in the output file.
+    """
+    subprocess.check_call([
+        sys.executable, SCRIPT, db_path,
+        u"--ndjson",
+        u"--incremental", state_path,
+        u"--output", output_path,
+    ])
+    return count_lines(output_path)
+
+
+def check_schema(temp_dir, name, args, repeat):
+    """
+    Check the given schema, returning a list of failure messages.
+    """
+    failures = []
+    db_path = os.path.join(temp_dir, name + u".sqlite")
+    state_path = os.path.join(temp_dir, name + u".json")
+    output_path = os.path.join(temp_dir, name + u".ndjson")
+    subprocess.check_call([sys.executable, GENERATOR, db_path, u"--books", u"5", u"--bookmarks", u"10"] + args)
+    first = export(db_path, state_path, output_path)
+    for i in range(repeat):
+        count = export(db_path, state_path, output_path)
+        if count != first:
+            failures.append(u"%s: run %d exported %d items again" % (name, i + 2, count - first))
+    sql_connection = sqlite3.connect(db_path)
+    for statement in INSERT_COPY:
+        sql_connection.execute(statement)
+    columns = [row[1] for row in sql_connection.execute(u"PRAGMA table_info(Bookmark);")]
+    if u"DateModified" in columns:
+        sql_connection.execute(UPDATE_DATEMODIFIED)
+    sql_connection.commit()
+    sql_connection.close()
+    count = export(db_path, state_path, output_path)
+    if count != first + 1:
+        failures.append(u"%s: a new item made the export grow by %d items instead of 1" % (name, count - first))
+    print(u"%-20s %s" % (name, u"FAIL" if len(failures) > 0 else u"OK"))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog=u"check-incremental",
+        description=u"Check the incremental export of export-kobo.py."
+    )
+    parser.add_argument("--repeat", type=int, default=2, help="Repeat the incremental export the given number of times, without changes (default: 2)")
+    parser.add_argument("--schemas", type=str, default=None, help="Comma-separated list of schemas to check (default: all)")
+    vargs = vars(parser.parse_args())
+
+    schemas = SCHEMAS
+    if vargs["schemas"] is not None:
+        selected = vargs["schemas"].split(u",")
+        schemas = [(n, a) for (n, a) in SCHEMAS if n in selected]
+
+    failures = []
+    temp_dir = tempfile.mkdtemp()
+    try:
+        for (name, args) in schemas:
+            failures.extend(check_schema(temp_dir, name, args, vargs["repeat"]))
+    finally:
+        shutil.rmtree(temp_dir)
+
+    if len(failures) > 0:
+        for failure in failures:
+            print(u"FAILURE: %s" % failure, file=sys.stderr)
+        sys.exit(1)
+
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
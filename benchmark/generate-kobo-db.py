@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2013-2017 Alberto Pettarin (alberto@albertopettarin.it)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Generate a synthetic KoboReader.sqlite file,
+with the same schema of the Bookmark and content tables
+read by export-kobo.py, for testing and benchmarking purposes.
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+import argparse
+import os
+import random
+import sqlite3
+import sys
+
+PY2 = (sys.version_info[0] == 2)
+
+if PY2:
+    # PY2
+    chr = unichr
+
+# NOTE: subset of the columns of the actual tables,
+#       including all the columns read by export-kobo.py
+SCRIPT_SCHEMA = u"""
+CREATE TABLE content (
+    ContentID TEXT NOT NULL,
+    ContentType TEXT NOT NULL,
+    MimeType TEXT NOT NULL,
+    BookID TEXT,
+    BookTitle TEXT,
+    ImageId TEXT,
+    Title TEXT COLLATE NOCASE,
+    Attribution TEXT COLLATE NOCASE,
+    Description TEXT,
+    DateCreated TEXT,
+    ShortCoverKey TEXT,
+    adobe_location TEXT,
+    Publisher TEXT,
+    IsEncrypted BOOL,
+    DateLastRead TEXT,
+    FirstTimeReading BOOL,
+    ChapterIDBookmarked TEXT,
+    ParagraphBookmarked INTEGER,
+    BookmarkWordOffset INTEGER,
+    NumShortcovers INTEGER,
+    VolumeIndex INTEGER,
+    ___NumPages INTEGER,
+    ReadStatus INTEGER,
+    ___SyncTime TEXT,
+    ___UserID TEXT NOT NULL,
+    PublicationId TEXT,
+    ___FileOffset INTEGER,
+    ___FileSize INTEGER,
+    ___PercentRead INTEGER,
+    ___ExpirationStatus INTEGER,
+    FavouritesIndex INTEGER DEFAULT -1,
+    Accessibility INTEGER DEFAULT 1,
+    ContentURL TEXT,
+    Language TEXT,
+    BookshelfTags TEXT,
+    IsDownloaded BIT DEFAULT 1,
+    PRIMARY KEY (ContentID)
+);
+CREATE INDEX content_bookid ON content (BookID);
+CREATE TABLE Bookmark (
+    BookmarkID TEXT NOT NULL,
+    VolumeID TEXT NOT NULL,
+    ContentID TEXT NOT NULL,
+    StartContainerPath TEXT NOT NULL,
+    StartContainerChildIndex INTEGER NOT NULL,
+    StartOffset INTEGER NOT NULL,
+    EndContainerPath TEXT NOT NULL,
+    EndContainerChildIndex INTEGER NOT NULL,
+    EndOffset INTEGER NOT NULL,
+    Text TEXT,
+    Annotation TEXT,
+    ExtraAnnotationData BLOB,
+    DateCreated TEXT,
+    ChapterProgress REAL NOT NULL DEFAULT 0,
+    Hidden BOOL NOT NULL DEFAULT 0,
+    Version TEXT,
+    DateModified TEXT,
+    Creator TEXT,
+    UUID TEXT,
+    UserID TEXT,
+    SyncTime TEXT,
+    Published BIT DEFAULT false,
+    ContextString TEXT,
+    Type TEXT,
+    PRIMARY KEY (BookmarkID)
+);
+CREATE INDEX bookmark_content ON Bookmark (ContentID);
+CREATE INDEX bookmark_volume ON Bookmark (VolumeID);
+"""
+
+INSERT_CONTENT = (
+    u"INSERT INTO content "
+    u"(ContentID, ContentType, MimeType, BookID, BookTitle, Title, Attribution, DateCreated, ___UserID) "
+    u"VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);"
+)
+
+INSERT_BOOKMARK = (
+    u"INSERT INTO Bookmark "
+    u"(BookmarkID, VolumeID, ContentID, StartContainerPath, StartContainerChildIndex, StartOffset, "
+    u"EndContainerPath, EndContainerChildIndex, EndOffset, Text, Annotation, ExtraAnnotationData, "
+    u"DateCreated, ChapterProgress, DateModified, Type) "
+    u"VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);"
+)
+
+# NOTE: old firmwares lack Bookmark.VolumeID
+INSERT_BOOKMARK_OLD = INSERT_BOOKMARK.replace(u"BookmarkID, VolumeID,", u"BookmarkID,").replace(u"VALUES (?, ", u"VALUES (", 1)
+
+ASCII_WORDS = u"the of and to in a is that it was he for on as with his be at by had not but from".split()
+
+UNICODE_WORDS = [
+    u"café",
+    u"naïve",
+    u"über",
+    u"šćž",
+    u"λόγος",
+    u"книга",
+    u"书",
+    u"本",
+    u"—",
+    u"“quoted”",
+]
+
+
+class Generator(object):
+    """
+    A class generating the rows of a synthetic KoboReader.sqlite file.
+    """
+
+    def __init__(self, vargs):
+        self.vargs = vargs
+        self.random = random.Random(vargs["seed"])
+
+    def words(self, length):
+        """
+        Return a random string of approximately the given length,
+        with the configured fraction of non-ASCII words.
+        """
+        acc = []
+        total = 0
+        while total < length:
+            if self.random.random() < self.vargs["unicode_ratio"]:
+                word = self.random.choice(UNICODE_WORDS)
+            else:
+                word = self.random.choice(ASCII_WORDS)
+            acc.append(word)
+            total += len(word) + 1
+        return u" ".join(acc)
+
+    def date(self):
+        """
+        Return a random date string, in the format used by Kobo,
+        or ``None`` with the configured probability.
+        """
+        if self.random.random() < self.vargs["null_date_ratio"]:
+            return None
+        return u"%04d-%02d-%02dT%02d:%02d:%02d.000" % (
+            self.random.randint(2012, 2018),
+            self.random.randint(1, 12),
+            self.random.randint(1, 28),
+            self.random.randint(0, 23),
+            self.random.randint(0, 59),
+            self.random.randint(0, 59),
+        )
+
+    def content_rows(self, book):
+        """
+        Yield the content rows of the given book:
+        the book itself, and its chapters.
+        """
+        volumeid = u"file:///mnt/onboard/library/book_%06d.epub" % book
+        title = u"%s %d" % (self.words(self.vargs["title_length"]).title(), book)
+        author = self.words(12).title()
+        yield (volumeid, u"6", u"application/epub+zip", None, None, title, author, self.date(), u"user")
+        for chapter in range(self.vargs["chapters"]):
+            contentid = u"%s#(%d)OEBPS/chapter%03d.xhtml" % (volumeid, chapter, chapter)
+            yield (contentid, u"9", u"application/xhtml+xml", volumeid, title, u"Chapter %d" % chapter, None, None, u"user")
+
+    def bookmark_rows(self, book):
+        """
+        Yield the Bookmark rows of the given book,
+        a random mix of annotations, highlights, and bookmarks.
+        """
+        volumeid = u"file:///mnt/onboard/library/book_%06d.epub" % book
+        for i in range(self.vargs["bookmarks"]):
+            chapter = i % max(self.vargs["chapters"], 1)
+            contentid = u"%s#(%d)OEBPS/chapter%03d.xhtml" % (volumeid, chapter, chapter)
+            r = self.random.random()
+            text = None
+            annotation = None
+            if r < 0.6:
+                text = self.words(self.random.randint(1, 2 * self.vargs["text_length"]))
+            elif r < 0.9:
+                text = self.words(self.random.randint(1, 2 * self.vargs["text_length"]))
+                annotation = self.words(self.random.randint(1, self.vargs["text_length"]))
+            datecreated = self.date()
+            datemodified = self.date() if datecreated is None else datecreated
+            yield (
+                u"%08x-%04x-%04x-%04x-%012x" % (book, i, 0, 0, self.random.getrandbits(48)),
+                volumeid,
+                contentid,
+                u"span#kobo\\.%d\\.1" % i,
+                0,
+                0,
+                u"span#kobo\\.%d\\.2" % i,
+                0,
+                self.random.randint(1, 200),
+                text,
+                annotation,
+                None,
+                datecreated,
+                self.random.random(),
+                datemodified,
+                u"note" if annotation is not None else (u"highlight" if text is not None else u"dogear"),
+            )
+
+    def generate(self, db_path):
+        """
+        Write the synthetic SQLite file at the given path.
+        """
+        script = SCRIPT_SCHEMA
+        insert_bookmark = INSERT_BOOKMARK
+        if self.vargs["old_schema"]:
+            script = script.replace(u"    VolumeID TEXT NOT NULL,\n", u"")
+            script = script.replace(u"CREATE INDEX bookmark_volume ON Bookmark (VolumeID);\n", u"")
+            insert_bookmark = INSERT_BOOKMARK_OLD
+        if self.vargs["no_datemodified"]:
+            script = script.replace(u"    DateModified TEXT,\n", u"")
+            insert_bookmark = insert_bookmark.replace(u"ChapterProgress, DateModified,", u"ChapterProgress,").replace(u"?, ?);", u"?);")
+        sql_connection = sqlite3.connect(db_path)
+        sql_connection.executescript(script)
+        for book in range(self.vargs["books"]):
+            sql_connection.executemany(INSERT_CONTENT, self.content_rows(book))
+            rows = self.bookmark_rows(book)
+            if self.vargs["old_schema"]:
+                rows = ((r[0],) + r[2:] for r in rows)
+            if self.vargs["no_datemodified"]:
+                rows = (r[:-2] + r[-1:] for r in rows)
+            sql_connection.executemany(insert_bookmark, rows)
+        sql_connection.commit()
+        sql_connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog=u"generate-kobo-db",
+        description=u"Generate a synthetic KoboReader.sqlite file."
+    )
+    parser.add_argument("db", type=str, help="Path of the output SQLite file")
+    parser.add_argument("--books", type=int, default=100, help="Number of books (default: 100)")
+    parser.add_argument("--bookmarks", type=int, default=50, help="Number of bookmarks per book (default: 50)")
+    parser.add_argument("--chapters", type=int, default=10, help="Number of chapters per book (default: 10)")
+    parser.add_argument("--text-length", type=int, default=200, help="Average length of highlighted texts, in characters (default: 200)")
+    parser.add_argument("--title-length", type=int, default=20, help="Average length of book titles, in characters (default: 20)")
+    parser.add_argument("--unicode-ratio", type=float, default=0.1, help="Fraction of non-ASCII words (default: 0.1)")
+    parser.add_argument("--null-date-ratio", type=float, default=0.05, help="Fraction of NULL dates (default: 0.05)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed (default: 0)")
+    parser.add_argument("--old-schema", action="store_true", help="Use the schema of old firmwares, without Bookmark.VolumeID")
+    parser.add_argument("--no-datemodified", action="store_true", help="Omit the Bookmark.DateModified column, as some old firmwares do")
+    vargs = vars(parser.parse_args())
+    if os.path.exists(vargs["db"]):
+        print(u"ERROR: The file '%s' already exists." % vargs["db"], file=sys.stderr)
+        sys.exit(1)
+    Generator(vargs).generate(vargs["db"])
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
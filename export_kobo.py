@@ -0,0 +1,1022 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2013-2017 Alberto Pettarin (alberto@albertopettarin.it)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Read annotations and highlights from a Kobo SQLite file.
+
+This module can be imported by other programs,
+which can open the SQLite file once with ``open_db()``,
+and then read books and items lazily
+with ``iter_books()`` and ``iter_items()``,
+formatting the latter with the ``render_*()`` functions.
+Errors are raised as ``KoboError`` exceptions.
+
+The ``export-kobo.py`` script is a command line interface
+built on top of this module.
+
+Example::
+
+    import export_kobo
+
+    sql_connection = export_kobo.open_db("KoboReader.sqlite")
+    for book in export_kobo.iter_books(sql_connection):
+        print(book.title)
+    for item in export_kobo.iter_items(sql_connection, kind=export_kobo.Item.HIGHLIGHT):
+        print(export_kobo.render_human(item))
+    sql_connection.close()
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+import collections
+import datetime
+import io
+import os
+import sqlite3
+import sys
+import time
+# NOTE: the modules needed only by some output formats
+#       (base64, csv, json) are imported where they are used,
+#       to keep the startup fast
+
+__author__ = "Alberto Pettarin"
+__email__ = "alberto@albertopettarin.it"
+__copyright__ = "Copyright 2013-2017, Alberto Pettarin (www.albertopettarin.it)"
+__license__ = "MIT"
+__status__ = "Production"
+__version__ = "2.1.1"
+
+
+PY2 = (sys.version_info[0] == 2)
+
+# NOTE: time.perf_counter() is not available on PY2
+TIMER = getattr(time, "perf_counter", time.time)
+
+DAYS = [
+    u"Monday",
+    u"Tuesday",
+    u"Wednesday",
+    u"Thursday",
+    u"Friday",
+    u"Saturday",
+    u"Sunday",
+]
+
+MONTHS = [
+    u"January",
+    u"February",
+    u"March",
+    u"April",
+    u"May",
+    u"June",
+    u"July",
+    u"August",
+    u"September",
+    u"October",
+    u"November",
+    u"December",
+]
+
+
+class DateFormatter(object):
+    """
+    A class formatting the ISO date strings stored in the SQLite file,
+    e.g. ``2014-12-19T19:54:11.000``,
+    caching the results, as many items share the same timestamp.
+
+    The cache is bounded: once it holds ``cache_size`` entries,
+    it is emptied and filled again.
+    """
+
+    DEFAULT_KINDLE = u"Thursday, 1 January 1970 00:00:00"
+
+    def __init__(self, cache_size=4096):
+        self.cache_size = cache_size
+        self.kindle_cache = {}
+
+    def kindle(self, date_string):
+        """
+        Return the given date string in the Kindle "My Clippings" format,
+        e.g. ``Friday, 19 December 2014 19:54:11``,
+        or the Unix epoch if the date string cannot be parsed.
+        """
+        try:
+            return self.kindle_cache[date_string]
+        except KeyError:
+            pass
+        except TypeError:
+            # unhashable
+            return self.DEFAULT_KINDLE
+        d = self.DEFAULT_KINDLE
+        try:
+            year, month, day, hour, minute, second = self.parse(date_string)
+            sday = DAYS[datetime.date(year, month, day).weekday()]
+            smonth = MONTHS[month - 1]
+            d = u"%s, %d %s %d %02d:%02d:%02d" % (sday, day, smonth, year, hour, minute, second)
+        except (AttributeError, IndexError, TypeError, ValueError):
+            pass
+        if len(self.kindle_cache) >= self.cache_size:
+            self.kindle_cache.clear()
+        self.kindle_cache[date_string] = d
+        return d
+
+    def parse(self, date_string):
+        """
+        Parse the given date string into a tuple
+        ``(year, month, day, hour, minute, second)`` of integers.
+
+        Raise ``ValueError`` if the date string cannot be parsed.
+        """
+        s = date_string
+        if (
+            (len(s) >= 19) and
+            (s[4] == u"-") and (s[7] == u"-") and (s[10] == u"T") and (s[13] == u":") and (s[16] == u":") and
+            ((len(s) == 19) or ((s[19] == u".") and s[20:].isdigit()))
+        ):
+            # fast path for the standard YYYY-MM-DDTHH:MM:SS.sss form
+            return (int(s[0:4]), int(s[5:7]), int(s[8:10]), int(s[11:13]), int(s[14:16]), int(s[17:19]))
+        p1, p2 = s.split("T")
+        year, month, day = [int(x) for x in p1.split("-")]
+        hour, minute, second = [int(float(x)) for x in p2.split(":")]
+        return (year, month, day, hour, minute, second)
+
+
+DATE_FORMATTER = DateFormatter()
+
+
+class KoboError(Exception):
+    """
+    Error raised while opening or reading a Kobo SQLite file.
+    """
+    pass
+
+
+class Item(object):
+    """
+    A class representing one of: annotation, bookmark, or highlight.
+
+    It is basically a named tuple, with some extra functions to
+    format the contents.
+
+    It uses ``__slots__``, as a large number of items
+    might be created while exporting a big SQLite file.
+    """
+
+    __slots__ = (
+        "volumeid",
+        "text",
+        "annotation",
+        "extraannotationdata",
+        "datecreated",
+        "datemodified",
+        "booktitle",
+        "title",
+        "author",
+        "kind",
+        "bookmarkid",
+    )
+
+    ANNOTATION = "annotation"
+    BOOKMARK = "bookmark"
+    HIGHLIGHT = "highlight"
+
+    # the date of the items without a creation or modification date
+    NO_DATE = u"1970-01-01T00:00:00.000"
+
+    def __init__(self, values):
+        self.volumeid = values[0]
+        self.text = values[1]
+        self.annotation = values[2]
+        self.extraannotationdata = values[3]
+        self.datecreated = values[4] if values[4] is not None else self.NO_DATE
+        self.datemodified = values[5] if values[5] is not None else self.NO_DATE
+        self.booktitle = values[6]
+        self.title = values[7]
+        self.author = values[8]
+        self.bookmarkid = values[10] if len(values) > 10 else None
+        if len(values) > 9:
+            # kind already classified by the query
+            self.kind = values[9]
+            return
+        self.kind = self.BOOKMARK
+        if (self.text is not None) and (self.text != "") and (self.annotation is not None) and (self.annotation != ""):
+            self.kind = self.ANNOTATION
+        elif (self.text is not None) and (self.text != ""):
+            self.kind = self.HIGHLIGHT
+
+    def __reduce__(self):
+        # NOTE: pickled as the tuple of its values,
+        #       which is faster than pickling each slot,
+        #       e.g. when sending items to worker processes
+        return (Item, ((
+            self.volumeid,
+            self.text,
+            self.annotation,
+            self.extraannotationdata,
+            self.datecreated,
+            self.datemodified,
+            self.booktitle,
+            self.title,
+            self.author,
+            self.kind,
+            self.bookmarkid,
+        ),))
+
+    def csv_tuple(self):
+        """
+        Return a tuple representing this Item, for CSV-output purposes.
+        """
+        return (self.kind, self.title, self.author, self.datecreated, self.datemodified, self.annotation, self.text)
+
+    def json_dict(self):
+        """
+        Return an ordered dictionary representing this Item, for JSON-output purposes.
+
+        The ``extraannotationdata`` value, if binary, is encoded in Base64.
+        """
+        extraannotationdata = self.extraannotationdata
+        if (extraannotationdata is not None) and (not isinstance(extraannotationdata, type(u""))):
+            import base64
+            extraannotationdata = base64.b64encode(bytes(extraannotationdata)).decode("ascii")
+        return collections.OrderedDict([
+            ("kind", self.kind),
+            ("title", self.title),
+            ("author", self.author),
+            ("booktitle", self.booktitle),
+            ("volumeid", self.volumeid),
+            ("bookmarkid", self.bookmarkid),
+            ("datecreated", self.datecreated),
+            ("datemodified", self.datemodified),
+            ("annotation", self.annotation),
+            ("text", self.text),
+            ("extraannotationdata", extraannotationdata),
+        ])
+
+    def kindle_my_clippings(self):
+        """
+        Return a string representing this Item, in the Kindle "My Clippings" format.
+        """
+        date = DATE_FORMATTER.kindle(self.datecreated)
+        acc = []
+        acc.append(u"%s (%s)" % (self.title, self.author))
+        if self.kind == self.ANNOTATION:
+            acc.append(u"- Your Note on page %d | location %d | Added on %s" % (1, 1, date))
+            acc.append(u"")
+            acc.append(self.annotation)
+        elif self.kind == self.HIGHLIGHT:
+            acc.append(u"- Your Highlight on page %d | location %d | Added on %s" % (1, 1, date))
+            acc.append(u"")
+            acc.append(self.text)
+        else:
+            acc.append(u"- Your Bookmark on page %d | location %d | Added on %s" % (1, 1, date))
+            acc.append(u"")
+        acc.append(u"==========")
+        return u"\n".join(acc)
+
+    def __repr__(self):
+        return u"(%s, %s, %s, %s, %s, %s, %s)" % self.csv_tuple()
+
+    def __str__(self):
+        acc = []
+        sep = u"\n=== === ===\n"
+        if self.kind == self.ANNOTATION:
+            acc.append(u"Type:           %s" % (self.kind))
+            acc.append(u"Title:          %s" % (self.title))
+            acc.append(u"Author:         %s" % (self.author))
+            acc.append(u"Date created:   %s" % (self.datecreated))
+            acc.append(u"Annotation:%s%s%s" % (sep, self.annotation, sep))
+            acc.append(u"Reference text:%s%s%s" % (sep, self.text, sep))
+        if self.kind == self.HIGHLIGHT:
+            acc.append(u"Type:           %s" % (self.kind))
+            acc.append(u"Title:          %s" % (self.title))
+            acc.append(u"Author:         %s" % (self.author))
+            acc.append(u"Date created:   %s" % (self.datecreated))
+            acc.append(u"Reference text:%s%s%s" % (sep, self.text, sep))
+        return u"\n".join(acc)
+
+
+class Book(object):
+    """
+    A class representing a book.
+
+    It is basically a named tuple, with some extra functions to
+    format the contents.
+    """
+
+    __slots__ = (
+        "volumeid",
+        "booktitle",
+        "title",
+        "author",
+    )
+
+    def __init__(self, values):
+        self.volumeid = values[0]
+        self.booktitle = values[1]
+        self.title = values[2]
+        self.author = values[3]
+
+    def __repr__(self):
+        return u"(%s, %s, %s, %s)" % (self.volumeid, self.booktitle, self.title, self.author)
+
+    def __str__(self):
+        return self.__repr__()
+
+
+class CSVSink(object):
+    """
+    A class writing CSV rows to a file object,
+    as soon as they are produced.
+
+    If a row cannot be encoded, it is written again
+    with the offending characters replaced.
+    """
+
+    def __init__(self, f):
+        import csv
+        self.f = f
+        if PY2:
+            # PY2: csv works on bytes, hence each row is encoded
+            #      into a small buffer, and then written to f
+            self.buffer = io.BytesIO()
+            self.writer = csv.writer(self.buffer)
+        else:
+            # PY3
+            self.buffer = None
+            self.writer = csv.writer(f)
+
+    def writerow(self, row):
+        """
+        Write the given row.
+        """
+        try:
+            self._writerow(row)
+        except UnicodeEncodeError:
+            self._writerow(tuple([self._ascii(v) for v in row]))
+
+    def writerows(self, rows):
+        """
+        Write the given rows, one at a time.
+        """
+        for row in rows:
+            self.writerow(row)
+
+    def _writerow(self, row):
+        if self.buffer is None:
+            # PY3
+            self.writer.writerow(row)
+        else:
+            # PY2
+            self.buffer.seek(0)
+            self.buffer.truncate(0)
+            self.writer.writerow(row)
+            self.f.write(self.buffer.getvalue().decode("utf-8"))
+
+    def _ascii(self, value):
+        if value is None:
+            return ""
+        if not isinstance(value, (type(u""), type(b""))):
+            return value
+        value = value.encode("ascii", errors="replace")
+        if not PY2:
+            # PY3
+            value = value.decode("ascii")
+        return value
+
+
+class Schema(object):
+    """
+    The queries reading a Kobo SQLite file,
+    built for the generation of its schema,
+    as detected by ``detect_schema()``.
+
+    Current firmwares store the book of each row of the Bookmark table
+    in ``Bookmark.VolumeID``, which is the ``ContentID`` of the book
+    in the content table.
+    Old firmwares do not have ``Bookmark.VolumeID``:
+    ``Bookmark.ContentID`` is the ``ContentID`` of the chapter,
+    whose ``BookID`` is the ``ContentID`` of the book.
+
+    Optional columns missing from the SQLite file are read as ``NULL``.
+    """
+
+    CURRENT = "current"
+    OLD = "old"
+
+    # columns that must exist, in all the generations
+    REQUIRED = {
+        "Bookmark": ["ContentID", "Text", "Annotation", "DateCreated"],
+        "content": ["ContentID", "Title"],
+    }
+
+    # columns of the current generation
+    BOOKMARK_COLUMNS = ["BookmarkID", "VolumeID", "ContentID", "Text", "Annotation", "ExtraAnnotationData", "DateCreated", "DateModified"]
+    CONTENT_COLUMNS = ["ContentID", "BookID", "BookTitle", "Title", "Attribution"]
+
+    def __init__(self, generation, bookmark_columns=BOOKMARK_COLUMNS, content_columns=CONTENT_COLUMNS):
+        self.generation = generation
+
+        def column(table, name):
+            columns = bookmark_columns if table == "Bookmark" else content_columns
+            return ("%s.%s" % (table, name)) if name in columns else "NULL"
+
+        booktitle = column("content", "BookTitle")
+        title = "content.Title"
+        attribution = column("content", "Attribution")
+        if generation == self.CURRENT:
+            volumeid = "Bookmark.VolumeID"
+            join = "Bookmark.VolumeID = content.ContentID"
+        elif "BookID" in content_columns:
+            # the book is read from the content row of the book, if any,
+            # falling back to the content row of the chapter
+            volumeid = "COALESCE(content.BookID, Bookmark.ContentID)"
+            join = (
+                "Bookmark.ContentID = content.ContentID "
+                "LEFT JOIN content AS book ON book.ContentID = content.BookID"
+            )
+            if "BookTitle" in content_columns:
+                booktitle = "CASE WHEN book.ContentID IS NULL THEN content.BookTitle ELSE book.BookTitle END"
+                title = "CASE WHEN book.ContentID IS NULL THEN COALESCE(content.BookTitle, content.Title) ELSE book.Title END"
+            else:
+                title = "COALESCE(book.Title, content.Title)"
+            if "Attribution" in content_columns:
+                attribution = "COALESCE(book.Attribution, content.Attribution)"
+        else:
+            volumeid = "Bookmark.ContentID"
+            join = "Bookmark.ContentID = content.ContentID"
+            if "BookTitle" in content_columns:
+                title = "COALESCE(content.BookTitle, content.Title)"
+        bookmarkid = "Bookmark.BookmarkID"
+        if "BookmarkID" not in bookmark_columns:
+            bookmarkid = "CAST(Bookmark.rowid AS TEXT)"
+        datemodified = column("Bookmark", "DateModified")
+
+        # NOTE: the kind of each item is classified by SQLite,
+        #       so that it can be used to filter rows in the WHERE clause
+        kind = (
+            "CASE "
+            "WHEN COALESCE(Bookmark.Text, '') != '' AND COALESCE(Bookmark.Annotation, '') != '' THEN '%s' "
+            "WHEN COALESCE(Bookmark.Text, '') != '' THEN '%s' "
+            "ELSE '%s' "
+            "END"
+        ) % (Item.ANNOTATION, Item.HIGHLIGHT, Item.BOOKMARK)
+
+        # NOTE: use build_items_query() to add the WHERE clause
+        self.query_items = (
+            "SELECT " +
+            ", ".join([
+                volumeid,
+                "Bookmark.Text",
+                "Bookmark.Annotation",
+                column("Bookmark", "ExtraAnnotationData"),
+                "Bookmark.DateCreated",
+                datemodified,
+                booktitle,
+                title,
+                attribution,
+                kind + " AS Kind",
+                bookmarkid,
+            ]) +
+            " FROM Bookmark INNER JOIN content ON " + join
+        )
+        self.query_books = (
+            "SELECT DISTINCT " +
+            ", ".join([volumeid, booktitle, title, attribution]) +
+            " FROM Bookmark INNER JOIN content ON " + join +
+            " ORDER BY " + title + ";"
+        )
+        self.query_books_count = (
+            "SELECT COUNT(*) FROM (SELECT DISTINCT " +
+            ", ".join([volumeid, booktitle, title, attribution]) +
+            " FROM Bookmark INNER JOIN content ON " + join +
+            ");"
+        )
+        # NOTE: use build_stats_query() to add the WHERE clause and the aggregates
+        self.query_stats = (
+            "SELECT " +
+            ", ".join([
+                volumeid + " AS VolumeID",
+                title + " AS Title",
+                attribution + " AS Attribution",
+                "Bookmark.Text AS Text",
+                "Bookmark.Annotation AS Annotation",
+                "Bookmark.DateCreated AS DateCreated",
+                kind + " AS Kind",
+            ]) +
+            " FROM Bookmark INNER JOIN content ON " + join
+        )
+        # NOTE: use build_items_page() to add the WHERE clause
+        self.query_item_rowids = (
+            "SELECT Bookmark.rowid AS ItemRowID, " + kind + " AS Kind" +
+            " FROM Bookmark INNER JOIN content ON " + join
+        )
+        self.query_bookmark_ids = "SELECT %s FROM Bookmark;" % bookmarkid
+        self.query_max_datemodified = "SELECT MAX(%s) FROM Bookmark;" % datemodified
+        # columns used by build_items_filters() and build_items_query()
+        self.items_columns = {
+            "volumeid": volumeid,
+            "title": title,
+            "kind": "Kind",
+            "datecreated": "Bookmark.DateCreated",
+            "datemodified": datemodified,
+        }
+
+    def __repr__(self):
+        return u"Schema(%s)" % self.generation
+
+
+CURRENT_SCHEMA = Schema(Schema.CURRENT)
+
+# the queries for the current generation of the schema
+QUERY_ITEMS = CURRENT_SCHEMA.query_items
+QUERY_BOOKS = CURRENT_SCHEMA.query_books
+ITEMS_COLUMNS = CURRENT_SCHEMA.items_columns
+
+# cache of the detected schemas, see detect_schema()
+SCHEMA_CACHE = {}
+
+# sort keys of build_items_order(),
+# and the corresponding keys of Schema.items_columns
+SORT_CREATED = "created"
+SORT_MODIFIED = "modified"
+SORT_TITLE = "title"
+SORT_COLUMNS = {
+    SORT_CREATED: "datecreated",
+    SORT_MODIFIED: "datemodified",
+    SORT_TITLE: "title",
+}
+
+# groups of build_stats_query(),
+# and the names of the key columns of each group
+STATS_TOTAL = "total"
+STATS_BOOK = "book"
+STATS_MONTH = "month"
+STATS_KEYS = {
+    STATS_TOTAL: [],
+    STATS_BOOK: ["volumeid", "title", "author"],
+    STATS_MONTH: ["month"],
+}
+
+# names of the aggregate columns of build_stats_query()
+STATS_COLUMNS = [
+    "books",
+    "items",
+    "annotations",
+    "highlights",
+    "bookmarks",
+    "avg_highlight_length",
+    "first_created",
+    "last_created",
+]
+
+
+def open_db(db_path, immutable=False, mmap_size=None, cache_size=None):
+    """
+    Open a read-only connection to the given SQLite file,
+    and return it.
+
+    If ``immutable`` is ``True``, SQLite assumes that the file
+    cannot change while it is open, and it does not lock it.
+    The ``mmap_size`` and ``cache_size`` values, if not ``None``,
+    are set with the corresponding PRAGMA statements.
+    """
+    if not os.path.exists(db_path):
+        raise KoboError(u"Unable to read the KoboReader.sqlite file. Please check that the path is correct and that you have read permission on it.")
+    try:
+        if PY2:
+            # PY2: sqlite3 does not support URI filenames
+            sql_connection = sqlite3.connect(db_path)
+        else:
+            # PY3
+            path = os.path.abspath(db_path)
+            if os.name == "nt":
+                from nturl2path import pathname2url
+                path = pathname2url(path)
+            else:
+                # NOTE: only ?, # and % must be escaped in the path of a SQLite URI,
+                #       hence urllib.request, which is slow to import, is not needed
+                path = path.replace(u"%", u"%25").replace(u"?", u"%3f").replace(u"#", u"%23")
+            uri = u"file:%s?mode=ro" % path
+            if immutable:
+                uri += u"&immutable=1"
+            sql_connection = sqlite3.connect(uri, uri=True)
+        if mmap_size is not None:
+            sql_connection.execute(u"PRAGMA mmap_size = %d;" % mmap_size)
+        if cache_size is not None:
+            sql_connection.execute(u"PRAGMA cache_size = %d;" % cache_size)
+    except Exception as exc:
+        raise KoboError(u"Unexpected error opening your KoboReader.sqlite file: %s" % (exc))
+    return sql_connection
+
+
+def snapshot_db(sql_connection, path=u":memory:", pages=4096, progress=None):
+    """
+    Copy the database open in the given connection
+    into a new SQLite database at the given path (by default, in memory),
+    with the online backup API, ``pages`` pages at a time,
+    and return a connection to the copy.
+
+    If not ``None``, ``progress(copied, total)`` is called
+    after each batch of pages has been copied.
+    """
+    if not hasattr(sql_connection, "backup"):
+        raise KoboError(u"Copying your KoboReader.sqlite file requires Python 3.7 or later.")
+
+    def report(status, remaining, total):
+        progress(total - remaining, total)
+
+    snapshot = None
+    try:
+        snapshot = sqlite3.connect(path)
+        # NOTE: the copy restarts automatically
+        #       if the SQLite file is written by another process meanwhile
+        sql_connection.backup(snapshot, pages=pages, progress=(report if progress is not None else None))
+    except sqlite3.Error as exc:
+        if snapshot is not None:
+            snapshot.close()
+        raise KoboError(u"Unexpected error copying your KoboReader.sqlite file: %s" % (exc))
+    return snapshot
+
+
+def detect_schema(sql_connection):
+    """
+    Detect the generation of the schema of the SQLite file
+    open in the given connection, with ``PRAGMA table_info``,
+    and return the corresponding Schema object.
+
+    The result is cached by path, size and mtime of the SQLite file,
+    hence each SQLite file is introspected once.
+
+    Raise ``KoboError`` if the SQLite file lacks the required tables or columns.
+    """
+    key = None
+    try:
+        path = sql_connection.execute(u"PRAGMA database_list;").fetchone()[2]
+        if path:
+            stat = os.stat(path)
+            key = (path, stat.st_size, stat.st_mtime)
+    except (sqlite3.Error, OSError, TypeError):
+        pass
+    if (key is not None) and (key in SCHEMA_CACHE):
+        return SCHEMA_CACHE[key]
+    columns = {}
+    try:
+        for table in ["Bookmark", "content"]:
+            columns[table] = [row[1] for row in sql_connection.execute(u"PRAGMA table_info(%s);" % table)]
+    except sqlite3.Error as exc:
+        raise KoboError(u"Unexpected error reading your KoboReader.sqlite file: %s" % (exc))
+    for table in ["Bookmark", "content"]:
+        if len(columns[table]) == 0:
+            raise KoboError(u"Unexpected error reading your KoboReader.sqlite file: no such table: %s" % (table))
+        missing = [c for c in Schema.REQUIRED[table] if c not in columns[table]]
+        if len(missing) > 0:
+            raise KoboError(u"Unexpected error reading your KoboReader.sqlite file: no such column: %s.%s" % (table, missing[0]))
+    generation = Schema.CURRENT if "VolumeID" in columns["Bookmark"] else Schema.OLD
+    if (
+        (generation == Schema.CURRENT) and
+        all([(c in columns["Bookmark"]) for c in Schema.BOOKMARK_COLUMNS]) and
+        all([(c in columns["content"]) for c in Schema.CONTENT_COLUMNS])
+    ):
+        schema = CURRENT_SCHEMA
+    else:
+        schema = Schema(generation, columns["Bookmark"], columns["content"])
+    if key is not None:
+        SCHEMA_CACHE[key] = schema
+    return schema
+
+
+def build_items_filters(columns, volumeid=None, title=None, kind=None, since=None, until=None):
+    """
+    Translate the given filters into a pair ``(clauses, parameters)``,
+    where ``clauses`` is a list of SQL conditions over the given columns
+    (a dictionary with keys ``volumeid``, ``title``, ``kind``,
+    and ``datecreated``).
+
+    The ``since`` and ``until`` dates are compared
+    with the ``DateCreated`` strings, hence they must be in ISO format,
+    e.g. ``2018-01-31`` or ``2018-01-31T12:00:00``:
+    only the rows created at or after ``since``,
+    and before ``until``, are selected.
+    """
+    clauses = []
+    parameters = []
+    if volumeid is not None:
+        clauses.append(u"%s = ?" % columns["volumeid"])
+        parameters.append(volumeid)
+    if title is not None:
+        clauses.append(u"%s = ?" % columns["title"])
+        parameters.append(title)
+    if kind is not None:
+        clauses.append(u"%s = ?" % columns["kind"])
+        parameters.append(kind)
+    if since is not None:
+        clauses.append(u"%s >= ?" % columns["datecreated"])
+        parameters.append(since)
+    if until is not None:
+        clauses.append(u"%s < ?" % columns["datecreated"])
+        parameters.append(until)
+    return (clauses, parameters)
+
+
+def build_items_order(columns, order_by=(), sort=None, reverse=False, tiebreak=None, limit=None, offset=None):
+    """
+    Translate the given sorting and paging options into a pair ``(clause, parameters)``,
+    where ``clause`` contains the ORDER BY and LIMIT clauses
+    over the given columns (see ``SORT_COLUMNS``),
+    or it is empty if no option is given.
+
+    The rows are sorted by the ``order_by`` expressions first,
+    then by the ``sort`` key, one of ``SORT_COLUMNS``
+    (in descending order, if ``reverse`` is ``True``),
+    and then by the ``tiebreak`` expression, if not ``None``.
+    """
+    keys = list(order_by)
+    if sort is not None:
+        if sort not in SORT_COLUMNS:
+            raise KoboError(u"Unknown sort key: %s" % (sort))
+        keys.append(u"%s %s" % (columns[SORT_COLUMNS[sort]], u"DESC" if reverse else u"ASC"))
+    if tiebreak is not None:
+        keys.append(tiebreak)
+    clause = u""
+    parameters = []
+    if len(keys) > 0:
+        clause += u" ORDER BY " + u", ".join(keys)
+    if (limit is not None) or (offset is not None):
+        # NOTE: a negative LIMIT means no limit
+        clause += u" LIMIT ? OFFSET ?"
+        parameters.extend([limit if limit is not None else -1, offset if offset is not None else 0])
+    return (clause, parameters)
+
+
+def build_items_page(rowid, query_rowids, columns, clauses, parameters, sort=None, reverse=False, tiebreak=None, limit=None, offset=None):
+    """
+    Build a pair ``(clause, parameters)``, where ``clause`` is an SQL condition
+    selecting the rows whose ``rowid`` is in the page of ``limit`` rows,
+    skipping the first ``offset``, of the rows of ``query_rowids``
+    matching the given ``clauses``, sorted by the ``sort`` key
+    and by the ``tiebreak`` expression (see ``build_items_order()``).
+    The rowid must be the ``ItemRowID`` column of ``query_rowids``.
+
+    The page can then be sorted differently, e.g. grouped by book,
+    while containing the same rows as the ungrouped query.
+    """
+    query = query_rowids
+    if len(clauses) > 0:
+        query += u" WHERE " + u" AND ".join(clauses)
+    order, order_parameters = build_items_order(columns, sort=sort, reverse=reverse, tiebreak=tiebreak, limit=limit, offset=offset)
+    return (u"%s IN (SELECT ItemRowID FROM (%s%s))" % (rowid, query, order), list(parameters) + order_parameters)
+
+
+def build_items_query(volumeid=None, title=None, kind=None, modified_since=None, order_by_book=False, schema=CURRENT_SCHEMA, since=None, until=None, sort=None, reverse=False, limit=None, offset=None):
+    """
+    Build the query selecting the Item rows
+    of the book with the given ``volumeid`` or ``title``,
+    of the given ``kind``, created in the given ``since``/``until`` range,
+    if not ``None`` (see ``build_items_filters()``),
+    for the given Schema.
+
+    If ``modified_since`` is not ``None``, only the rows
+    modified at or after that date, or without a modification date,
+    are selected.
+    If ``order_by_book`` is ``True``, the rows of each book are contiguous.
+    The rows are sorted by the ``sort`` key, if not ``None``,
+    and at most ``limit`` rows are selected, skipping the first ``offset``
+    (see ``build_items_order()``), before grouping them by book.
+
+    Return a pair ``(query, parameters)``.
+    """
+    columns = schema.items_columns
+    clauses, parameters = build_items_filters(columns, volumeid, title, kind, since, until)
+    if modified_since is not None:
+        clauses.append(u"(%s >= ? OR %s IS NULL)" % (columns["datemodified"], columns["datemodified"]))
+        parameters.append(modified_since)
+    paging = (limit is not None) or (offset is not None)
+    tiebreak = u"Bookmark.rowid" if (order_by_book or (sort is not None) or paging) else None
+    if order_by_book and paging:
+        # NOTE: select the page of the sorted rows first,
+        #       otherwise the page would be taken from the rows grouped by book
+        page, page_parameters = build_items_page(u"Bookmark.rowid", schema.query_item_rowids, columns, clauses, parameters, sort, reverse, tiebreak, limit, offset)
+        clauses = clauses + [page]
+        parameters = parameters + page_parameters
+        limit = None
+        offset = None
+    query = schema.query_items
+    if len(clauses) > 0:
+        query += u" WHERE " + u" AND ".join(clauses)
+    order, order_parameters = build_items_order(
+        columns,
+        order_by=([columns["volumeid"]] if order_by_book else []),
+        sort=sort,
+        reverse=reverse,
+        tiebreak=tiebreak,
+        limit=limit,
+        offset=offset
+    )
+    return (query + order + u";", tuple(parameters + order_parameters))
+
+
+def build_stats_query(group_by=STATS_TOTAL, volumeid=None, title=None, kind=None, schema=CURRENT_SCHEMA, since=None, until=None):
+    """
+    Build the query computing the statistics of the Item rows
+    selected by the given filters (see ``build_items_query()``),
+    overall (``STATS_TOTAL``), per book (``STATS_BOOK``),
+    or per month of their creation date (``STATS_MONTH``),
+    for the given Schema.
+
+    Each row contains the ``STATS_KEYS`` of the group,
+    followed by the ``STATS_COLUMNS``.
+    The statistics are computed by SQLite,
+    hence no Python object is created for each Item row.
+
+    Return a pair ``(query, parameters)``.
+    """
+    if group_by not in STATS_KEYS:
+        raise KoboError(u"Unknown statistics group: %s" % (group_by))
+    clauses, parameters = build_items_filters(schema.items_columns, volumeid, title, kind, since, until)
+    query = schema.query_stats
+    if len(clauses) > 0:
+        query += u" WHERE " + u" AND ".join(clauses)
+    keys = {
+        STATS_TOTAL: [],
+        STATS_BOOK: [u"VolumeID", u"Title", u"Attribution"],
+        STATS_MONTH: [u"SUBSTR(DateCreated, 1, 7) AS Month"],
+    }[group_by]
+    # NOTE: the kinds are counted as in the Kind column,
+    #       but without evaluating it for each aggregate,
+    #       as NULL != '' is not true
+    aggregates = [
+        u"1" if group_by == STATS_BOOK else u"COUNT(DISTINCT VolumeID)",
+        u"COUNT(*)",
+        u"COUNT(CASE WHEN Text != '' AND Annotation != '' THEN 1 END)",
+        u"COUNT(CASE WHEN Text != '' AND COALESCE(Annotation, '') = '' THEN 1 END)",
+        u"COUNT(CASE WHEN COALESCE(Text, '') = '' THEN 1 END)",
+        u"AVG(CASE WHEN Text != '' THEN LENGTH(Text) END)",
+        u"MIN(DateCreated)",
+        u"MAX(DateCreated)",
+    ]
+    query = u"SELECT %s FROM (%s)" % (u", ".join(keys + aggregates), query)
+    if group_by == STATS_BOOK:
+        # NOTE: the title and author depend on the VolumeID only
+        query += u" GROUP BY VolumeID ORDER BY Title, VolumeID"
+    elif group_by == STATS_MONTH:
+        query += u" GROUP BY Month ORDER BY Month"
+    return (query + u";", tuple(parameters))
+
+
+def iter_query(sql_connection, query, parameters=(), factory=None, timings=None):
+    """
+    Run the given query over the given connection,
+    binding the given parameters,
+    and yield the resulting rows lazily from the cursor.
+
+    If ``factory`` is not ``None``, each row is converted
+    by calling ``factory(row)`` directly in the SQLite row factory.
+
+    If ``timings`` is not ``None``, its method ``add(stage, seconds, rows)``
+    is called with the time spent running the query (stage ``query``),
+    fetching each row (``fetch``), and converting it (``construct``).
+    """
+    try:
+        sql_cursor = sql_connection.cursor()
+        if (factory is not None) and (timings is not None):
+            def timed_factory(cursor, row):
+                start = TIMER()
+                obj = factory(row)
+                timings.add("construct", TIMER() - start, 1)
+                return obj
+            sql_cursor.row_factory = timed_factory
+        elif factory is not None:
+            sql_cursor.row_factory = lambda cursor, row: factory(row)
+        start = TIMER()
+        sql_cursor.execute(query, parameters)
+        if timings is not None:
+            timings.add("query", TIMER() - start, 1)
+    except sqlite3.Error as exc:
+        raise KoboError(u"Unexpected error reading your KoboReader.sqlite file: %s" % (exc))
+    try:
+        if timings is None:
+            for row in sql_cursor:
+                yield row
+        else:
+            rows = iter(sql_cursor)
+            while True:
+                start = TIMER()
+                try:
+                    row = next(rows)
+                except StopIteration:
+                    break
+                timings.add("fetch", TIMER() - start, 1)
+                yield row
+    except sqlite3.Error as exc:
+        raise KoboError(u"Unexpected error reading your KoboReader.sqlite file: %s" % (exc))
+    finally:
+        try:
+            sql_cursor.close()
+        except sqlite3.ProgrammingError:
+            # NOTE: the connection was closed already,
+            #       e.g., after an error writing the output
+            pass
+
+
+def iter_books(sql_connection):
+    """
+    Yield the Book objects with annotations, bookmarks or highlights,
+    sorted by title.
+    """
+    return iter_query(sql_connection, detect_schema(sql_connection).query_books, factory=Book)
+
+
+def iter_items(sql_connection, volumeid=None, title=None, kind=None, modified_since=None, order_by_book=False, schema=None, timings=None, **kwargs):
+    """
+    Yield the Item objects selected by the given filters,
+    one at a time, as soon as they are read.
+
+    See ``build_items_query()`` for the meaning of the filters,
+    and for the other keyword arguments
+    (``since``, ``until``, ``sort``, ``reverse``, ``limit``, ``offset``),
+    and ``iter_query()`` for the meaning of ``timings``.
+    The query is chosen according to the given schema,
+    or to the one detected from the SQLite file, if ``None``.
+    """
+    if schema is None:
+        schema = detect_schema(sql_connection)
+    query, parameters = build_items_query(volumeid, title, kind, modified_since, order_by_book, schema, **kwargs)
+    return iter_query(sql_connection, query, parameters, factory=Item, timings=timings)
+
+
+def iter_stats(sql_connection, group_by=STATS_TOTAL, volumeid=None, title=None, kind=None, since=None, until=None):
+    """
+    Yield the rows of statistics of the Item rows
+    selected by the given filters, as tuples.
+
+    See ``build_stats_query()`` for the meaning of the arguments,
+    and for the columns of each row.
+    """
+    schema = detect_schema(sql_connection)
+    query, parameters = build_stats_query(group_by, volumeid, title, kind, schema, since, until)
+    return iter_query(sql_connection, query, parameters)
+
+
+def json_string(obj):
+    """
+    Return the given object serialized as a one-line JSON string.
+    """
+    import json
+    return u"%s" % json.dumps(obj, ensure_ascii=False)
+
+
+def render_human(item):
+    """
+    Return the given Item in a human-readable format.
+    """
+    return u"%s\n" % item
+
+
+def render_raw(item):
+    """
+    Return the text of the given Item.
+    """
+    return u"%s\n" % item.text
+
+
+def render_kindle(item):
+    """
+    Return the given Item in the Kindle "My Clippings" format.
+    """
+    return item.kindle_my_clippings()
+
+
+def render_csv(item):
+    """
+    Return the given Item as a CSV row, to be written with ``CSVSink``.
+    """
+    return item.csv_tuple()
+
+
+def render_json(item):
+    """
+    Return the given Item as a one-line JSON string.
+    """
+    return json_string(item.json_dict())
@@ -0,0 +1,2601 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2013-2017 Alberto Pettarin (alberto@albertopettarin.it)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Export annotations and highlights from a Kobo SQLite file.
+
+This is the command line interface of the ``export_kobo`` module,
+run by the ``export-kobo.py`` script.
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+import argparse
+import collections
+import io
+import itertools
+import os
+import re
+import sqlite3
+import sys
+import time
+# NOTE: the modules needed only by some modes
+#       (e.g., glob, hashlib, json, multiprocessing)
+#       are imported where they are used, to keep the startup fast
+
+import export_kobo
+from export_kobo import Book
+from export_kobo import CSVSink
+from export_kobo import Item
+from export_kobo import KoboError
+from export_kobo import PY2
+from export_kobo import TIMER
+
+__author__ = "Alberto Pettarin"
+__email__ = "alberto@albertopettarin.it"
+__copyright__ = "Copyright 2013-2017, Alberto Pettarin (www.albertopettarin.it)"
+__license__ = "MIT"
+__status__ = "Production"
+__version__ = "2.1.1"
+
+
+class Timings(object):
+    """
+    A class accumulating wall time, row counts, and bytes
+    for each stage of an export.
+    """
+
+    STAGES = [
+        "open",
+        "snapshot",
+        "query",
+        "fetch",
+        "construct",
+        "render",
+        "write",
+    ]
+
+    def __init__(self):
+        self.start = TIMER()
+        self.end = None
+        self.stages = dict([(stage, [0.0, 0, 0]) for stage in self.STAGES])
+
+    def add(self, stage, seconds, rows=0, nbytes=0):
+        """
+        Add the given amounts to the given stage.
+        """
+        acc = self.stages[stage]
+        acc[0] += seconds
+        acc[1] += rows
+        acc[2] += nbytes
+
+    def timed_map(self, function, values, stage):
+        """
+        Yield ``function(value)`` for each of the given values,
+        adding the time spent in ``function`` to the given stage.
+        """
+        for value in values:
+            start = TIMER()
+            result = function(value)
+            self.add(stage, TIMER() - start, 1)
+            yield result
+
+    def stop(self):
+        """
+        Stop the clock of the whole run.
+        """
+        self.end = TIMER()
+
+    def as_dict(self):
+        """
+        Return a dictionary with the accumulated data.
+
+        The time spent in the ``construct`` stage,
+        which happens while fetching rows from the cursor,
+        is not counted in the ``fetch`` stage.
+        """
+        stages = {}
+        for stage in self.STAGES:
+            seconds, rows, nbytes = self.stages[stage]
+            if stage == "fetch":
+                seconds = max(seconds - self.stages["construct"][0], 0.0)
+            stages[stage] = {"seconds": seconds, "rows": rows, "bytes": nbytes}
+        end = self.end if self.end is not None else TIMER()
+        return {"total_seconds": end - self.start, "stages": stages}
+
+    def as_text(self):
+        """
+        Return a human-readable table with the accumulated data.
+        """
+        data = self.as_dict()
+        acc = []
+        acc.append(u"%-10s %12s %12s %14s" % (u"Stage", u"Seconds", u"Rows", u"Bytes"))
+        for stage in self.STAGES:
+            d = data["stages"][stage]
+            acc.append(u"%-10s %12.6f %12d %14d" % (stage, d["seconds"], d["rows"], d["bytes"]))
+        acc.append(u"%-10s %12.6f" % (u"total", data["total_seconds"]))
+        return u"\n".join(acc)
+
+
+class TimedFile(object):
+    """
+    A file-like object writing to a file object,
+    accumulating the time spent and the bytes written (UTF-8)
+    in the ``write`` stage of the given ``Timings``.
+    """
+
+    def __init__(self, f, timings):
+        self.f = f
+        self.timings = timings
+
+    def write(self, string):
+        start = TIMER()
+        self.f.write(string)
+        self.timings.add("write", TIMER() - start, 1, len(string.encode("utf-8")))
+
+
+class CommandLineToolError(Exception):
+    """
+    Error raised by ``CommandLineTool.error()``,
+    instead of exiting, if ``raise_errors`` is ``True``.
+    """
+    pass
+
+
+class CommandLineTool(object):
+    """
+    A class providing a generic command line tool,
+    with the associated functions, error reporting, etc.
+
+    It is based on ``argparse``.
+    """
+
+    # overload in the actual subclass
+    #
+    AP_PROGRAM = sys.argv[0]
+    AP_DESCRIPTION = u"Generic Command Line Tool"
+    AP_ARGUMENTS = [
+        # required args
+        # {"name": "foo", "nargs": 1, "type": str, "default": "baz", "help": "Foo help"},
+        #
+        # optional args
+        # {"name": "--bar", "nargs": "?", "type": str,, "default": "foofoofoo", "help": "Bar help"},
+        # {"name": "--quiet", "action": "store_true", "help": "Do not output to stdout"},
+    ]
+
+    def __init__(self):
+        self.parser = None
+        self.vargs = None
+        self.raise_errors = False
+
+    def build_parser(self):
+        """
+        Build the argument parser from ``AP_ARGUMENTS``.
+
+        The parser is built only when the command line is parsed,
+        and not when the tool is used programmatically,
+        setting ``vargs`` directly.
+        """
+        self.parser = argparse.ArgumentParser(
+            prog=self.AP_PROGRAM,
+            description=self.AP_DESCRIPTION
+        )
+        for arg in self.AP_ARGUMENTS:
+            if "action" in arg:
+                self.parser.add_argument(
+                    arg["name"],
+                    action=arg["action"],
+                    help=arg["help"]
+                )
+            else:
+                self.parser.add_argument(
+                    arg["name"],
+                    nargs=arg["nargs"],
+                    type=arg["type"],
+                    default=arg["default"],
+                    choices=arg.get("choices"),
+                    help=arg["help"]
+                )
+
+    def run(self):
+        """
+        Run the command line tool.
+        """
+        self.build_parser()
+        self.vargs = vars(self.parser.parse_args())
+        self.actual_command()
+        sys.exit(0)
+
+    def actual_command(self):
+        """
+        The actual command to be run.
+
+        This function is meant to be overridden in an actual subclass.
+        """
+        self.print_stdout(u"This script does nothing. Invoke another .py")
+
+    def error(self, message):
+        """
+        Print an error and exit with exit code 1.
+
+        If ``raise_errors`` is ``True``, raise ``CommandLineToolError``
+        with the given message instead.
+        """
+        if self.raise_errors:
+            raise CommandLineToolError(message)
+        self.print_stderr(u"ERROR: %s" % message)
+        sys.exit(1)
+
+    def print_stdout(self, *args, **kwargs):
+        """
+        Print to standard out.
+        """
+        print(*args, **kwargs)
+
+    def print_stderr(self, *args, **kwargs):
+        """
+        Print to standard error.
+        """
+        print(*args, file=sys.stderr, **kwargs)
+
+
+class TeeFile(object):
+    """
+    A file-like object writing to a file object,
+    and a copy of what has been written to another one.
+
+    If writing to the former fails with ``UnicodeEncodeError``,
+    the next write, which replaces the offending string,
+    is not copied.
+    """
+
+    def __init__(self, f, copy):
+        self.f = f
+        self.copy = copy
+        self.skip = False
+
+    def write(self, string):
+        if self.skip:
+            self.skip = False
+        else:
+            self.copy.write(string)
+        try:
+            self.f.write(string)
+        except UnicodeEncodeError:
+            self.skip = True
+            raise
+
+
+class Inotify(object):
+    """
+    A minimal wrapper around the Linux inotify API, through ctypes,
+    reporting the names of the files changed in the watched directories.
+
+    Raise ``OSError`` if inotify is not available.
+    """
+
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+
+    MASK = (
+        IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+        IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+    )
+
+    def __init__(self):
+        # NOTE: on Windows, ctypes.CDLL(None) raises TypeError,
+        #       and os.O_NONBLOCK does not exist
+        if not sys.platform.startswith("linux"):
+            raise OSError(u"inotify is not available")
+        import ctypes
+        try:
+            self.libc = ctypes.CDLL(None, use_errno=True)
+            self.libc.inotify_init1
+            self.libc.inotify_add_watch
+        except (AttributeError, OSError, TypeError):
+            raise OSError(u"inotify is not available")
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), u"inotify_init1 failed")
+        self.wd = None
+
+    def watch(self, directory):
+        """
+        Watch the given directory, replacing the previous watch, if any.
+
+        Return ``True`` on success.
+        """
+        if self.wd is not None:
+            self.libc.inotify_rm_watch(self.fd, self.wd)
+        wd = self.libc.inotify_add_watch(self.fd, directory.encode(sys.getfilesystemencoding()), self.MASK)
+        self.wd = wd if wd >= 0 else None
+        return self.wd is not None
+
+    def read(self, timeout):
+        """
+        Wait up to ``timeout`` seconds for events,
+        and return the list of the names of the changed files.
+        """
+        import select
+        import struct
+        names = []
+        ready = select.select([self.fd], [], [], timeout)[0]
+        if len(ready) == 0:
+            return names
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError:
+            return names
+        offset = 0
+        while offset + 16 <= len(data):
+            wd, mask, cookie, length = struct.unpack_from("iIII", data, offset)
+            name = data[offset + 16:offset + 16 + length].rstrip(b"\0")
+            names.append(name.decode(sys.getfilesystemencoding(), "replace"))
+            if mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF):
+                # the directory itself is gone, e.g. the device was unmounted
+                self.wd = None
+            offset += 16 + length
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FileWatcher(object):
+    """
+    A class waiting for changes to a SQLite file,
+    including its ``-wal`` and ``-journal`` files,
+    which might not exist yet, e.g. on a device not mounted yet.
+
+    It uses inotify, if available, falling back to polling
+    the ``os.stat()`` of the files every ``interval`` seconds.
+    """
+
+    SUFFIXES = [u"", u"-wal", u"-journal"]
+
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self.names = set([os.path.basename(path) + s for s in self.SUFFIXES])
+        try:
+            self.inotify = Inotify()
+        except OSError:
+            self.inotify = None
+        self.last = self.signature()
+
+    def signature(self):
+        """
+        Return a tuple describing the current state of the files.
+        """
+        acc = []
+        for suffix in self.SUFFIXES:
+            try:
+                stat = os.stat(self.path + suffix)
+                acc.append((stat.st_ino, stat.st_size, stat.st_mtime))
+            except OSError:
+                acc.append(None)
+        return tuple(acc)
+
+    def changed(self, timeout):
+        """
+        Wait up to ``timeout`` seconds, and return ``True``
+        if the files changed in the meantime.
+
+        With inotify, return as soon as a change is reported.
+        """
+        notified = False
+        if (self.inotify is not None) and (self.inotify.wd is None):
+            directory = os.path.dirname(os.path.abspath(self.path))
+            if os.path.isdir(directory):
+                self.inotify.watch(directory)
+        if (self.inotify is not None) and (self.inotify.wd is not None):
+            # NOTE: the stat() signature is checked anyway,
+            #       as inotify does not report e.g. (un)mounting a device
+            names = self.inotify.read(max(0.0, min(timeout, self.interval)))
+            notified = any([(n in self.names) for n in names])
+        else:
+            time.sleep(max(0.0, min(timeout, self.interval)))
+        signature = self.signature()
+        changed = notified or (signature != self.last)
+        self.last = signature
+        return changed
+
+    def wait(self, debounce):
+        """
+        Block until the files change, and then until
+        they do not change for ``debounce`` seconds,
+        so that a burst of writes is reported once.
+        """
+        while not self.changed(self.interval):
+            pass
+        quiet_since = time.time()
+        while time.time() - quiet_since < debounce:
+            if self.changed(debounce - (time.time() - quiet_since)):
+                quiet_since = time.time()
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+
+
+class ExportKobo(CommandLineTool):
+    """
+    The actual command line tool to export
+    annotations, bookmarks, and highlights
+    from a Kobo SQLite file.
+    """
+
+    AP_PROGRAM = u"export-kobo"
+    AP_DESCRIPTION = u"Export annotations and highlights from a Kobo SQLite file."
+    AP_ARGUMENTS = [
+        {
+            "name": "db",
+            "nargs": None,
+            "type": str,
+            "default": None,
+            "help": "Path of the input KoboReader.sqlite file, or a directory or a glob pattern of several such files"
+        },
+        {
+            "name": "--output",
+            "nargs": "?",
+            "type": str,
+            "default": None,
+            "help": "Output to file instead of using the standard output"
+        },
+        {
+            "name": "--output-dir",
+            "nargs": "?",
+            "type": str,
+            "default": None,
+            "help": "When exporting several SQLite files, output to one file per SQLite file in the given directory"
+        },
+        {
+            "name": "--split-by-book",
+            "nargs": "?",
+            "type": str,
+            "default": None,
+            "help": "Output the items of each book to a separate file in the given directory"
+        },
+        {
+            "name": "--workers",
+            "nargs": "?",
+            "type": int,
+            "default": None,
+            "help": "When exporting several SQLite files, use the given number of worker processes; with --split-by-book, the number of writer threads (default: number of CPUs)"
+        },
+        {
+            "name": "--jobs",
+            "nargs": "?",
+            "type": int,
+            "default": None,
+            "help": "Render the items of large human-readable, Kindle, or JSON outputs in the given number of worker processes, writing them in the original order (default: 1)"
+        },
+        {
+            "name": "--csv",
+            "action": "store_true",
+            "help": "Output in CSV format instead of human-readable format"
+        },
+        {
+            "name": "--kindle",
+            "action": "store_true",
+            "help": "Output in Kindle 'My Clippings.txt' format instead of human-readable format"
+        },
+        {
+            "name": "--list",
+            "action": "store_true",
+            "help": "List the titles of books with annotations or highlights"
+        },
+        {
+            "name": "--book",
+            "nargs": "?",
+            "type": str,
+            "default": None,
+            "help": "Output annotations and highlights only from the book with the given title"
+        },
+        {
+            "name": "--bookid",
+            "nargs": "?",
+            "type": str,
+            "default": None,
+            "help": "Output annotations and highlights only from the book with the given ID"
+        },
+        {
+            "name": "--annotations-only",
+            "action": "store_true",
+            "help": "Outputs annotations only, excluding highlights"
+        },
+        {
+            "name": "--highlights-only",
+            "action": "store_true",
+            "help": "Outputs highlights only, excluding annotations"
+        },
+        {
+            "name": "--since",
+            "nargs": "?",
+            "type": str,
+            "default": None,
+            "help": "Output only the items created at or after the given date (YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS), or in the given number of days (e.g., 7d)"
+        },
+        {
+            "name": "--until",
+            "nargs": "?",
+            "type": str,
+            "default": None,
+            "help": "Output only the items created before the given date (YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS), or the given number of days ago (e.g., 7d)"
+        },
+        {
+            "name": "--sort",
+            "nargs": "?",
+            "type": str,
+            "default": None,
+            "choices": ["created", "modified", "title"],
+            "help": "Sort the items by creation date, modification date, or book title"
+        },
+        {
+            "name": "--reverse",
+            "action": "store_true",
+            "help": "With --sort, sort the items in descending order (e.g., newest first)"
+        },
+        {
+            "name": "--limit",
+            "nargs": "?",
+            "type": int,
+            "default": None,
+            "help": "Output at most the given number of items"
+        },
+        {
+            "name": "--offset",
+            "nargs": "?",
+            "type": int,
+            "default": None,
+            "help": "Skip the given number of items, before outputting them"
+        },
+        {
+            "name": "--info",
+            "action": "store_true",
+            "help": "Print information about the number of annotations and highlights"
+        },
+        {
+            "name": "--stats",
+            "action": "store_true",
+            "help": "Output the number of books and items by kind, the average highlight length, and the first and last creation dates, overall, per book, and per month"
+        },
+        {
+          "name": "--raw",
+          "action": "store_true",
+          "help": "Output in raw text instead of human-readable format"
+        },
+        {
+            "name": "--json",
+            "action": "store_true",
+            "help": "Output in JSON format (an array of objects) instead of human-readable format"
+        },
+        {
+            "name": "--ndjson",
+            "action": "store_true",
+            "help": "Output in newline-delimited JSON format (one object per line) instead of human-readable format"
+        },
+        {
+            "name": "--parquet",
+            "action": "store_true",
+            "help": "Output in Parquet columnar format to the --output file (requires pyarrow)"
+        },
+        {
+            "name": "--arrow",
+            "action": "store_true",
+            "help": "Output in Arrow IPC columnar format to the --output file (requires pyarrow)"
+        },
+        {
+            "name": "--sqlite-out",
+            "nargs": "?",
+            "type": str,
+            "default": None,
+            "help": "Output books and items into the given normalized SQLite archive, updating the rows already there"
+        },
+        {
+            "name": "--device",
+            "nargs": "?",
+            "type": str,
+            "default": None,
+            "help": "Name of the source device, stored in the --sqlite-out archive (default: the absolute path of the SQLite file)"
+        },
+        {
+            "name": "--batch-size",
+            "nargs": "?",
+            "type": int,
+            "default": 65536,
+            "help": "Number of items per record batch, in the columnar output formats and in --sqlite-out (default: 65536)"
+        },
+        {
+            "name": "--immutable",
+            "action": "store_true",
+            "help": "Open the KoboReader.sqlite file as immutable, skipping locking (use only on a copy of the file)"
+        },
+        {
+            "name": "--mmap-size",
+            "nargs": "?",
+            "type": int,
+            "default": None,
+            "help": "Set the SQLite mmap_size pragma, in bytes"
+        },
+        {
+            "name": "--cache-size",
+            "nargs": "?",
+            "type": int,
+            "default": None,
+            "help": "Set the SQLite cache_size pragma, in pages (or in KiB, if negative)"
+        },
+        {
+            "name": "--snapshot",
+            "action": "store_true",
+            "help": "Copy the SQLite file into memory, and run all the queries on the copy, releasing the SQLite file (e.g., on the device) as soon as the copy is done"
+        },
+        {
+            "name": "--snapshot-dir",
+            "nargs": "?",
+            "type": str,
+            "default": None,
+            "help": "As --snapshot, but copy the SQLite file into a temporary file in the given local directory, removed at the end"
+        },
+        {
+            "name": "--snapshot-pages",
+            "nargs": "?",
+            "type": int,
+            "default": 4096,
+            "help": "With --snapshot, number of pages copied at each step, or 0 to copy the whole file in one step (default: 4096)"
+        },
+        {
+            "name": "--incremental",
+            "nargs": "?",
+            "type": str,
+            "default": None,
+            "help": "Export only the items created or modified since the last run, as recorded in the given state file, appending them to the output file"
+        },
+        {
+            "name": "--watch",
+            "action": "store_true",
+            "help": "Keep running, and export the items created or modified each time the SQLite file (or the .kobo/KoboReader.sqlite file in the given mount directory) changes"
+        },
+        {
+            "name": "--watch-interval",
+            "nargs": "?",
+            "type": float,
+            "default": 1.0,
+            "help": "With --watch, check the SQLite file for changes every given number of seconds, if inotify is not available (default: 1.0)"
+        },
+        {
+            "name": "--watch-debounce",
+            "nargs": "?",
+            "type": float,
+            "default": 2.0,
+            "help": "With --watch, export only after the SQLite file did not change for the given number of seconds (default: 2.0)"
+        },
+        {
+            "name": "--cache",
+            "nargs": "?",
+            "type": str,
+            "default": None,
+            "help": "Cache the output in the given directory, and reuse it if the SQLite file has not changed"
+        },
+        {
+            "name": "--search",
+            "nargs": "?",
+            "type": str,
+            "default": None,
+            "help": "Output only the annotations and highlights matching the given full-text search query, best matches first"
+        },
+        {
+            "name": "--search-index",
+            "nargs": "?",
+            "type": str,
+            "default": None,
+            "help": "Path of the full-text search index file (default: the path of the SQLite file plus '.fts')"
+        },
+        {
+            "name": "--timings",
+            "action": "store_true",
+            "help": "Print wall time, row counts, and bytes of each stage of the export to standard error"
+        },
+        {
+            "name": "--timings-json",
+            "action": "store_true",
+            "help": "As --timings, but print a single JSON line"
+        },
+        {
+            "name": "--profile",
+            "nargs": "?",
+            "type": str,
+            "default": None,
+            "help": "Profile the whole run with cProfile, and save the statistics (pstats) to the given file"
+        },
+    ]
+
+    FORMAT_CSV = "csv"
+    FORMAT_HUMAN = "human"
+    FORMAT_JSON = "json"
+    FORMAT_KINDLE = "kindle"
+    FORMAT_NDJSON = "ndjson"
+    FORMAT_RAW = "raw"
+    FORMAT_PARQUET = "parquet"
+    FORMAT_ARROW = "arrow"
+
+    # NOTE: a --since or --until date given as a number of days, e.g. 7d
+    RELATIVE_DATE = r"^([0-9]+)d$"
+
+    # NOTE: the options changing the output cached by --cache,
+    #       besides the output format, see cache_key()
+    CACHE_OPTIONS = [
+        "list",
+        "stats",
+        "book",
+        "bookid",
+        "annotations_only",
+        "highlights_only",
+        "since",
+        "until",
+        "sort",
+        "reverse",
+        "limit",
+        "offset",
+        "search",
+    ]
+
+    # NOTE: the archive written by --sqlite-out,
+    #       where (source, volumeid) and (source, bookmarkid)
+    #       are the stable keys used to update existing rows
+    SCRIPT_ARCHIVE = (
+        "CREATE TABLE IF NOT EXISTS books ("
+        "id INTEGER PRIMARY KEY, "
+        "source TEXT NOT NULL, "
+        "volumeid TEXT NOT NULL, "
+        "booktitle TEXT, "
+        "title TEXT, "
+        "author TEXT, "
+        "UNIQUE (source, volumeid)"
+        "); "
+        "CREATE TABLE IF NOT EXISTS items ("
+        "id INTEGER PRIMARY KEY, "
+        "book_id INTEGER NOT NULL REFERENCES books (id), "
+        "source TEXT NOT NULL, "
+        "bookmarkid TEXT NOT NULL, "
+        "kind TEXT NOT NULL, "
+        "text TEXT, "
+        "annotation TEXT, "
+        "extraannotationdata BLOB, "
+        "datecreated TEXT, "
+        "datemodified TEXT, "
+        "UNIQUE (source, bookmarkid)"
+        "); "
+        "CREATE INDEX IF NOT EXISTS items_book_id ON items (book_id); "
+        "CREATE INDEX IF NOT EXISTS items_datecreated ON items (datecreated); "
+        "CREATE INDEX IF NOT EXISTS books_title ON books (title);"
+    )
+
+    # NOTE: upserts are done with INSERT OR IGNORE followed by UPDATE,
+    #       as INSERT ... ON CONFLICT DO UPDATE requires SQLite 3.24
+    ARCHIVE_INSERT_BOOK = (
+        "INSERT OR IGNORE INTO books (source, volumeid, booktitle, title, author) "
+        "VALUES (?, ?, ?, ?, ?);"
+    )
+
+    ARCHIVE_UPDATE_BOOK = (
+        "UPDATE books SET booktitle = ?, title = ?, author = ? "
+        "WHERE source = ? AND volumeid = ?;"
+    )
+
+    ARCHIVE_INSERT_ITEM = (
+        "INSERT OR IGNORE INTO items "
+        "(book_id, source, bookmarkid, kind, text, annotation, extraannotationdata, datecreated, datemodified) "
+        "VALUES ((SELECT id FROM books WHERE source = ? AND volumeid = ?), ?, ?, ?, ?, ?, ?, ?, ?);"
+    )
+
+    ARCHIVE_UPDATE_ITEM = (
+        "UPDATE items SET "
+        "book_id = (SELECT id FROM books WHERE source = ? AND volumeid = ?), "
+        "kind = ?, text = ?, annotation = ?, extraannotationdata = ?, datecreated = ?, datemodified = ? "
+        "WHERE source = ? AND bookmarkid = ?;"
+    )
+
+    # Item fields written by export_columnar(),
+    # as pairs (name, dictionary-encoded)
+    COLUMNAR_FIELDS = [
+        ("kind", True),
+        ("title", True),
+        ("author", True),
+        ("booktitle", True),
+        ("volumeid", True),
+        ("bookmarkid", False),
+        ("datecreated", False),
+        ("datemodified", False),
+        ("annotation", False),
+        ("text", False),
+        ("extraannotationdata", False),
+    ]
+
+    # NOTE: the full-text search index is a separate SQLite file,
+    #       containing a copy of the Schema.query_items rows in the items table,
+    #       indexed by the items_fts (FTS5) table
+    SCRIPT_SEARCH_INDEX = (
+        "CREATE TABLE meta (Key TEXT PRIMARY KEY, Value TEXT); "
+        "CREATE TABLE items ("
+        "VolumeID, Text, Annotation, ExtraAnnotationData, DateCreated, DateModified, "
+        "BookTitle, Title, Attribution, Kind, BookmarkID"
+        "); "
+        "CREATE VIRTUAL TABLE items_fts USING fts5("
+        "Text, Annotation, Title, Attribution, content='items', content_rowid='rowid'"
+        ");"
+    )
+
+    QUERY_SEARCH_META = "SELECT Value FROM meta WHERE Key = 'source';"
+
+    # NOTE: not a tuple, just a continuation string!
+    #       use build_search_query() to add the WHERE clause
+    QUERY_SEARCH = (
+        "SELECT "
+        "items.VolumeID, "
+        "items.Text, "
+        "items.Annotation, "
+        "items.ExtraAnnotationData, "
+        "items.DateCreated, "
+        "items.DateModified, "
+        "items.BookTitle, "
+        "items.Title, "
+        "items.Attribution, "
+        "items.Kind, "
+        "items.BookmarkID "
+        "FROM items_fts INNER JOIN items "
+        "ON items_fts.rowid = items.rowid"
+    )
+
+    # NOTE: the rowids of the matching items, used to page them
+    #       before grouping them by book, see build_search_query()
+    QUERY_SEARCH_ROWIDS = (
+        "SELECT items.rowid AS ItemRowID, rank "
+        "FROM items_fts INNER JOIN items "
+        "ON items_fts.rowid = items.rowid"
+    )
+
+    # columns used by export_kobo.build_items_filters() and build_items_order()
+    SEARCH_COLUMNS = {
+        "volumeid": "items.VolumeID",
+        "title": "items.Title",
+        "kind": "items.Kind",
+        "datecreated": "items.DateCreated",
+        "datemodified": "items.DateModified",
+    }
+
+    QUERY_COUNT = "SELECT COUNT(*) FROM Bookmark;"
+
+    # NOTE: with --jobs, the items are sent to the worker processes
+    #       in chunks of JOBS_CHUNK_SIZE items, but only if there are
+    #       at least JOBS_MIN_ITEMS items, otherwise starting the pool
+    #       would take longer than rendering them in this process
+    JOBS_CHUNK_SIZE = 1000
+    JOBS_MIN_ITEMS = 10000
+
+    def __init__(self):
+        super(ExportKobo, self).__init__()
+        self.items_count = 0
+        self.source = None
+        self.state = None
+        self.append = False
+        self.cached_books_count = None
+        self.books = None
+        self.volumeid = None
+        self.sql_connection = None
+        self.search_connection = None
+        self.snapshot_path = None
+        self.sql_schema = None
+        self.timings = None
+        self.exported = None
+
+    def actual_command(self):
+        """
+        The main function of the tool: parse the parameters,
+        read the given SQLite file, and format/output data as requested,
+        optionally collecting timings or profiling data.
+        """
+        if self.vargs["timings"] or self.vargs["timings_json"]:
+            self.timings = Timings()
+        try:
+            if self.vargs["profile"] is not None:
+                import cProfile
+                profiler = cProfile.Profile()
+                try:
+                    profiler.runcall(self.export_command)
+                finally:
+                    profiler.dump_stats(self.vargs["profile"])
+            else:
+                self.export_command()
+        finally:
+            # NOTE: remove the --snapshot-dir copy, even after an error
+            self.close()
+        if self.timings is not None:
+            self.timings.stop()
+            if self.vargs["timings"]:
+                self.print_stderr(self.timings.as_text())
+            if self.vargs["timings_json"]:
+                import json
+                data = self.timings.as_dict()
+                data["db"] = self.vargs["db"]
+                data["items"] = self.items_count
+                self.print_stderr(json.dumps(data, sort_keys=True))
+
+    def export_command(self):
+        """
+        Read the given SQLite file(s), and format/output data as requested.
+        """
+        if self.vargs["db"] is None:
+            self.error(u"You must specify the path to your KoboReader.sqlite file.")
+
+        if (self.vargs["limit"] is not None) or (self.vargs["offset"] is not None):
+            if (self.vargs["limit"] or 0) < 0 or (self.vargs["offset"] or 0) < 0:
+                self.error(u"The limit and the offset must be non-negative integers.")
+            for option in ["incremental", "watch", "stats"]:
+                if self.vargs[option]:
+                    self.error(u"You cannot specify --limit or --offset with --%s." % option)
+
+        if (self.vargs["jobs"] is not None) and (self.vargs["jobs"] < 1):
+            self.error(u"The number of jobs must be a positive integer.")
+
+        # NOTE: rejected before the first run writes the state file
+        if self.vargs["incremental"] is not None:
+            if self.vargs["split_by_book"] is not None:
+                self.error(u"You cannot specify both --incremental and --split-by-book.")
+            if self.vargs["search"] is not None:
+                self.error(u"You cannot specify both --search and --incremental.")
+            # NOTE: a JSON array cannot be appended to
+            if self.output_format() == self.FORMAT_JSON:
+                self.error(u"You cannot specify both --json and --incremental, please use --ndjson instead.")
+            # NOTE: neither can a Parquet or Arrow IPC file
+            if self.output_format() in [self.FORMAT_PARQUET, self.FORMAT_ARROW]:
+                self.error(u"You cannot specify both --%s and --incremental, please use --ndjson instead." % self.output_format())
+
+        if self.vargs["sqlite_out"] is not None:
+            # NOTE: the archive is the only output
+            for option in ["output", "output_dir", "split_by_book", "list", "csv", "kindle", "raw", "json", "ndjson", "parquet", "arrow"]:
+                if self.vargs[option]:
+                    self.error(u"You cannot specify both --sqlite-out and --%s." % option.replace(u"_", u"-"))
+
+        if self.vargs["watch"]:
+            # keep exporting the changes
+            self.watch()
+            return
+
+        db_paths = self.find_databases()
+        if db_paths is not None:
+            # export several SQLite files
+            if self.vargs["split_by_book"] is not None:
+                self.error(u"You cannot specify --split-by-book when exporting several SQLite files.")
+            self.export_fleet(db_paths)
+            return
+
+        databases = None
+        if self.vargs["incremental"] is not None:
+            databases = self.load_state()
+            self.set_state(databases.get(self.state_key()))
+
+        if self.vargs["stats"]:
+            for option in ["list", "split_by_book", "sqlite_out", "search", "incremental", "parquet", "arrow", "sort"]:
+                if self.vargs[option]:
+                    self.error(u"You cannot specify both --stats and --%s." % option.replace(u"_", u"-"))
+
+        if self.vargs["sqlite_out"] is not None:
+            # write to a SQLite archive
+            self.export_archive(self.vargs["sqlite_out"])
+        elif self.vargs["split_by_book"] is not None:
+            # write to one file per book
+            if self.vargs["list"]:
+                self.error(u"You cannot specify both --list and --split-by-book.")
+            self.export_split(self.vargs["split_by_book"])
+        elif self.output_format() in [self.FORMAT_PARQUET, self.FORMAT_ARROW]:
+            # write to a binary file
+            if self.vargs["output"] is None:
+                self.error(u"You must specify the output file with --output for the columnar output formats.")
+            self.export_columnar(self.vargs["output"])
+        elif self.vargs["output"] is not None:
+            # write to file
+            mode = "a" if self.append else "w"
+            try:
+                with io.open(self.vargs["output"], mode, encoding="utf-8") as f:
+                    self.export_cached(f)
+            except IOError:
+                self.error(u"Unable to write output file. Please check that the path is correct and that you have write permission on it.")
+        else:
+            # write to stdout
+            self.export_cached(sys.stdout)
+            if self.output_format() != self.FORMAT_NDJSON:
+                self.write_string(sys.stdout, u"\n")
+
+        if databases is not None:
+            state, deleted = self.update_state()
+            databases[self.state_key()] = state
+            self.save_state(databases)
+            self.report_deleted(deleted)
+
+        if self.vargs["info"]:
+            # print some info about the extraction
+            self.print_stdout(u"")
+            self.print_stdout(u"Books with annotations or highlights: %d" % self.books_count())
+            if not (self.vargs["list"] or self.vargs["stats"]):
+                self.print_stdout(u"Annotations and/or highlights:        %d" % self.items_count)
+
+        self.close()
+
+    def export(self, f, items=None):
+        """
+        Format the data requested by the user,
+        and write it to the given file object.
+
+        If ``items`` is not ``None``, format the given Item objects,
+        instead of querying the SQLite file.
+        If ``self.source`` is not ``None``, the output is tagged with it.
+        """
+        if self.timings is not None:
+            f = TimedFile(f, self.timings)
+        output_format = self.output_format()
+        if self.vargs["list"]:
+            # export list of books
+            books = self.enumerate_books()
+            if output_format == self.FORMAT_CSV:
+                rendered = itertools.chain(
+                    [(u"ID", u"TITLE", u"AUTHOR")],
+                    ((i, b.title, b.author) for (i, b) in books)
+                )
+            elif output_format in [self.FORMAT_JSON, self.FORMAT_NDJSON]:
+                rendered = (
+                    self.json_string(collections.OrderedDict([
+                        ("id", i),
+                        ("title", b.title),
+                        ("author", b.author),
+                        ("volumeid", b.volumeid),
+                    ]))
+                    for (i, b) in books
+                )
+            else:
+                rendered = itertools.chain(
+                    [u"ID\tTITLE\tAUTHOR"],
+                    ((u"%s\t%s\t%s" % (i, b.title, b.author)) for (i, b) in books)
+                )
+        elif self.vargs["stats"]:
+            # export statistics
+            rendered = self.render_stats(output_format)
+        else:
+            # export annotations and/or highlights
+            # NOTE: items is a generator, hence the rows are read,
+            #       formatted, and written one at a time
+            if output_format == self.FORMAT_KINDLE:
+                render = export_kobo.render_kindle
+            elif output_format == self.FORMAT_CSV:
+                render = export_kobo.render_csv
+            elif output_format in [self.FORMAT_JSON, self.FORMAT_NDJSON]:
+                if self.source is not None:
+                    render = lambda i: self.json_string(i.json_dict())
+                else:
+                    render = export_kobo.render_json
+            elif output_format == self.FORMAT_RAW:
+                render = export_kobo.render_raw
+            else:
+                render = export_kobo.render_human
+            # NOTE: rendering CSV and raw rows is cheaper
+            #       than sending them to a worker process,
+            #       and the items of --split-by-book are rendered by threads,
+            #       or, in a fleet export, by worker processes already
+            parallel = (
+                ((self.vargs["jobs"] or 1) > 1) and
+                (output_format in [self.FORMAT_KINDLE, self.FORMAT_JSON, self.FORMAT_NDJSON, self.FORMAT_HUMAN]) and
+                (self.source is None) and
+                (items is None)
+            )
+            if items is None:
+                items = self.iter_items()
+            if parallel:
+                rendered = self.render_parallel(render, items)
+            elif self.timings is not None:
+                rendered = self.timings.timed_map(render, items, "render")
+            else:
+                rendered = (render(i) for i in items)
+
+        if output_format == self.FORMAT_CSV:
+            # CSV format: rendered yields tuples
+            if self.source is not None:
+                rendered = (((self.source,) + tuple(r)) for r in rendered)
+            CSVSink(f).writerows(rendered)
+        elif output_format == self.FORMAT_JSON:
+            self.write_chunks(f, self.iter_json_array(rendered))
+        elif output_format == self.FORMAT_NDJSON:
+            # NOTE: each record ends with a newline, hence the output
+            #       can be appended to, and consumed while it is written
+            self.write_lines(f, rendered)
+        else:
+            if self.source is not None:
+                rendered = itertools.chain([u"Source: %s\n" % self.source], rendered)
+            self.write_chunks(f, rendered, append=self.append)
+
+    def export_columnar(self, output_path, items=None):
+        """
+        Write the Item objects requested by the user
+        (or the given ones, if ``items`` is not ``None``)
+        to the given file, in Parquet or Arrow IPC format,
+        in record batches of ``--batch-size`` items.
+
+        The title, author, and other repeated strings are dictionary-encoded,
+        with a single dictionary per column, extended batch after batch.
+
+        This requires the optional ``pyarrow`` package.
+        """
+        try:
+            import pyarrow
+            import pyarrow.ipc
+            import pyarrow.parquet
+        except ImportError:
+            self.error(u"The --parquet and --arrow options require the pyarrow package. Please install it with 'pip install pyarrow'.")
+        batch_size = self.vargs["batch_size"]
+        if (batch_size is None) or (batch_size < 1):
+            self.error(u"The batch size must be a positive integer.")
+
+        fields = self.COLUMNAR_FIELDS
+        dictionary_type = pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+        schema = pyarrow.schema([
+            (
+                name,
+                dictionary_type if encoded else (pyarrow.binary() if name == "extraannotationdata" else pyarrow.string())
+            )
+            for (name, encoded) in fields
+        ])
+        # for each dictionary-encoded column, map each value to its index
+        indices = dict([(name, {}) for (name, encoded) in fields if encoded])
+        dictionaries = dict([(name, []) for (name, encoded) in fields if encoded])
+
+        def column(name, encoded, values):
+            if not encoded:
+                if name == "extraannotationdata":
+                    values = [(v.encode("utf-8") if isinstance(v, type(u"")) else (None if v is None else bytes(v))) for v in values]
+                return pyarrow.array(values, type=schema.field(name).type)
+            mapping = indices[name]
+            dictionary = dictionaries[name]
+            acc = []
+            for v in values:
+                if v is None:
+                    acc.append(None)
+                    continue
+                i = mapping.get(v)
+                if i is None:
+                    i = len(dictionary)
+                    mapping[v] = i
+                    dictionary.append(v)
+                acc.append(i)
+            return pyarrow.DictionaryArray.from_arrays(
+                pyarrow.array(acc, type=pyarrow.int32()),
+                pyarrow.array(dictionary, type=pyarrow.string())
+            )
+
+        def write_batch(writer, batch):
+            start = TIMER()
+            record_batch = pyarrow.record_batch(
+                [column(name, encoded, [getattr(i, name) for i in batch]) for (name, encoded) in fields],
+                schema=schema
+            )
+            if self.timings is not None:
+                self.timings.add("render", TIMER() - start, len(batch))
+            start = TIMER()
+            if self.vargs["parquet"]:
+                writer.write_table(pyarrow.Table.from_batches([record_batch]))
+            else:
+                writer.write_batch(record_batch)
+            if self.timings is not None:
+                self.timings.add("write", TIMER() - start, 1, record_batch.nbytes)
+
+        try:
+            if self.vargs["parquet"]:
+                writer = pyarrow.parquet.ParquetWriter(output_path, schema)
+            else:
+                options = pyarrow.ipc.IpcWriteOptions(emit_dictionary_deltas=True)
+                writer = pyarrow.ipc.new_file(output_path, schema, options=options)
+        except (IOError, OSError, pyarrow.ArrowException):
+            self.error(u"Unable to write output file. Please check that the path is correct and that you have write permission on it.")
+        if items is None:
+            items = self.iter_items()
+        try:
+            batch = []
+            for item in items:
+                batch.append(item)
+                if len(batch) >= batch_size:
+                    write_batch(writer, batch)
+                    batch = []
+            if len(batch) > 0:
+                write_batch(writer, batch)
+        finally:
+            writer.close()
+
+    def export_archive(self, archive_path):
+        """
+        Write the Item objects requested by the user,
+        and their books, into the given SQLite archive,
+        in batches of ``--batch-size`` items, in a single transaction.
+
+        Books and items already in the archive,
+        with the same source device and ``volumeid`` or ``bookmarkid``,
+        are updated.
+        """
+        batch_size = self.vargs["batch_size"]
+        if (batch_size is None) or (batch_size < 1):
+            self.error(u"The batch size must be a positive integer.")
+        source = self.vargs["device"]
+        if source is None:
+            source = os.path.abspath(self.vargs["db"])
+        try:
+            # NOTE: a long timeout, as the workers of a fleet export
+            #       might write to the same archive concurrently
+            archive = sqlite3.connect(archive_path, timeout=600)
+            archive.executescript(self.SCRIPT_ARCHIVE)
+        except sqlite3.Error as exc:
+            self.error(u"Unable to open the SQLite archive '%s': %s" % (archive_path, exc))
+
+        def write_batch(batch):
+            start = TIMER()
+            books = {}
+            for i in batch:
+                books[i.volumeid] = (i.booktitle, i.title, i.author)
+            archive.executemany(
+                self.ARCHIVE_INSERT_BOOK,
+                [(source, v, b[0], b[1], b[2]) for (v, b) in books.items()]
+            )
+            archive.executemany(
+                self.ARCHIVE_UPDATE_BOOK,
+                [(b[0], b[1], b[2], source, v) for (v, b) in books.items()]
+            )
+            archive.executemany(
+                self.ARCHIVE_INSERT_ITEM,
+                [
+                    (source, i.volumeid, source, i.bookmarkid, i.kind, i.text, i.annotation, i.extraannotationdata, i.datecreated, i.datemodified)
+                    for i in batch
+                ]
+            )
+            archive.executemany(
+                self.ARCHIVE_UPDATE_ITEM,
+                [
+                    (source, i.volumeid, i.kind, i.text, i.annotation, i.extraannotationdata, i.datecreated, i.datemodified, source, i.bookmarkid)
+                    for i in batch
+                ]
+            )
+            if self.timings is not None:
+                self.timings.add("write", TIMER() - start, len(batch))
+
+        try:
+            archive.execute(u"BEGIN IMMEDIATE;")
+            batch = []
+            for item in self.iter_items():
+                batch.append(item)
+                if len(batch) >= batch_size:
+                    write_batch(batch)
+                    batch = []
+            if len(batch) > 0:
+                write_batch(batch)
+            archive.commit()
+        except sqlite3.Error as exc:
+            archive.rollback()
+            self.error(u"Unable to write the SQLite archive '%s': %s" % (archive_path, exc))
+        finally:
+            archive.close()
+
+    def watch(self):
+        """
+        Export the items requested by the user,
+        and then, each time the SQLite file changes,
+        the items created or modified since the previous export,
+        until interrupted.
+
+        The SQLite file is kept open between exports,
+        unless it is replaced or it disappears (e.g., the device is unplugged).
+        If ``--incremental`` is specified, the state is saved after each export,
+        so that a later run resumes from it.
+        """
+        if self.vargs["watch_interval"] <= 0:
+            self.error(u"The watch interval must be a positive number.")
+        if self.vargs["watch_debounce"] < 0:
+            self.error(u"The watch debounce must be a non-negative number.")
+        for option in ["list", "stats", "split_by_book", "sqlite_out", "search", "cache", "immutable"]:
+            if self.vargs[option]:
+                self.error(u"You cannot specify both --watch and --%s." % option.replace(u"_", u"-"))
+        if self.output_format() in [self.FORMAT_JSON, self.FORMAT_PARQUET, self.FORMAT_ARROW]:
+            self.error(u"You cannot append to a JSON or columnar output, please use --ndjson with --watch.")
+        db_path = self.vargs["db"]
+        if os.path.isdir(db_path):
+            # mount directory of the device
+            db_path = os.path.join(db_path, u".kobo", u"KoboReader.sqlite")
+            self.vargs["db"] = db_path
+
+        databases = None
+        if self.vargs["incremental"] is not None:
+            databases = self.load_state()
+            self.set_state(databases.get(self.state_key()))
+        watcher = FileWatcher(db_path, self.vargs["watch_interval"])
+        inode = None
+        exported = self.state is not None
+        # NOTE: an error, e.g. reading a SQLite file still being copied,
+        #       is reported, and the next change is waited for
+        raise_errors = self.raise_errors
+        self.raise_errors = True
+        try:
+            while True:
+                stat = None
+                try:
+                    stat = os.stat(db_path)
+                except OSError:
+                    # e.g., the device was unplugged
+                    self.close()
+                    inode = None
+                if stat is not None:
+                    replaced = (stat.st_ino != inode)
+                    if replaced or self.snapshotting():
+                        # the SQLite file was replaced, or it appeared,
+                        # or a fresh copy of it is needed
+                        self.close()
+                    # NOTE: the list of books might have changed
+                    self.books = None
+                    self.volumeid = None
+                    try:
+                        self.export_changes(append=exported)
+                        exported = exported or (self.items_count > 0)
+                        if replaced:
+                            # NOTE: the new file might not be a newer version
+                            #       of the old one, hence read all the bookmark IDs
+                            self.exported = None
+                        state, deleted = self.update_state()
+                        self.set_state(state)
+                        if databases is not None:
+                            databases[self.state_key()] = state
+                            self.save_state(databases)
+                        self.report_deleted(deleted)
+                        if self.vargs["info"]:
+                            self.print_stderr(u"Annotations and/or highlights: %d" % self.items_count)
+                        inode = stat.st_ino
+                    except CommandLineToolError as exc:
+                        self.print_stderr(u"ERROR: %s" % exc)
+                        self.close()
+                        inode = None
+                watcher.wait(self.vargs["watch_debounce"])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.raise_errors = raise_errors
+            watcher.close()
+            self.close()
+
+    def export_changes(self, append):
+        """
+        Export the items created or modified since the previous export
+        (all of them, in the first export) to the output file or to stdout,
+        separating them from the previous output, if ``append`` is ``True``.
+        """
+        self.append = append and ((self.vargs["output"] is None) or os.path.exists(self.vargs["output"]))
+        if self.vargs["output"] is None:
+            self.export(sys.stdout)
+            sys.stdout.flush()
+            return
+        try:
+            with io.open(self.vargs["output"], "a" if self.append else "w", encoding="utf-8") as f:
+                self.export(f)
+        except IOError:
+            self.error(u"Unable to write output file. Please check that the path is correct and that you have write permission on it.")
+
+    def output_extension(self):
+        """
+        Return the file extension for the output format requested by the user.
+        """
+        return {
+            self.FORMAT_CSV: u".csv",
+            self.FORMAT_JSON: u".json",
+            self.FORMAT_NDJSON: u".ndjson",
+            self.FORMAT_PARQUET: u".parquet",
+            self.FORMAT_ARROW: u".arrow",
+        }.get(self.output_format(), u".txt")
+
+    def export_split(self, output_dir):
+        """
+        Write the Item objects requested by the user
+        to one file per book in the given directory.
+
+        The items are read once, with the items of each book contiguous,
+        and each book is written by a pool of threads,
+        while the items of the next books are read.
+        """
+        import multiprocessing
+        import multiprocessing.pool
+        if not os.path.isdir(output_dir):
+            try:
+                os.makedirs(output_dir)
+            except OSError:
+                self.error(u"Unable to create the output directory '%s'." % output_dir)
+        workers = self.vargs["workers"]
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        if workers < 1:
+            self.error(u"The number of workers must be a positive integer.")
+        columnar = self.output_format() in [self.FORMAT_PARQUET, self.FORMAT_ARROW]
+
+        def export_book(path, items):
+            if columnar:
+                self.export_columnar(path, items)
+                return
+            try:
+                with io.open(path, "w", encoding="utf-8") as f:
+                    self.export(f, items)
+            except IOError:
+                self.error(u"Unable to write output file '%s'." % path)
+
+        # NOTE: errors in the threads must not exit,
+        #       hence they are raised and reported once all threads are done
+        raise_errors = self.raise_errors
+        self.raise_errors = True
+        message = None
+        pool = multiprocessing.pool.ThreadPool(workers)
+        pending = collections.deque()
+        try:
+            items = self.iter_items(order_by_book=True)
+            for volumeid, group in itertools.groupby(items, key=lambda i: i.volumeid):
+                group = list(group)
+                path = os.path.join(output_dir, self.book_file_name(group[0]))
+                pending.append(pool.apply_async(export_book, (path, group)))
+                # limit the number of books held in memory
+                while len(pending) > 2 * workers:
+                    pending.popleft().get()
+            while len(pending) > 0:
+                pending.popleft().get()
+        except CommandLineToolError as exc:
+            message = u"%s" % exc
+        finally:
+            pool.close()
+            pool.join()
+            self.raise_errors = raise_errors
+        if message is not None:
+            self.error(message)
+
+    def book_file_name(self, item):
+        """
+        Return a safe and stable file name for the book of the given item,
+        made from its title and a hash of its ``volumeid``.
+        """
+        import hashlib
+        title = item.title if item.title else u"book"
+        title = re.sub(u"[^\\w\\-]+", u"_", title, flags=re.UNICODE).strip(u"_")[:64]
+        digest = hashlib.sha1((item.volumeid or u"").encode("utf-8")).hexdigest()[:10]
+        return u"%s-%s%s" % (title, digest, self.output_extension())
+
+    def output_format(self):
+        """
+        Return the output format requested by the user.
+
+        If several formats are requested, ``--parquet`` takes precedence,
+        followed by ``--arrow``, ``--kindle``, ``--csv``, ``--json``, ``--ndjson``, and ``--raw``.
+        The book list (``--list``) and the statistics (``--stats``)
+        support only the CSV, JSON, and the default tab-separated formats.
+        """
+        listing = self.vargs["list"] or self.vargs["stats"]
+        if (self.vargs["parquet"] or self.vargs["arrow"]) and (not listing):
+            return self.FORMAT_PARQUET if self.vargs["parquet"] else self.FORMAT_ARROW
+        if self.vargs["kindle"] and (not listing):
+            return self.FORMAT_KINDLE
+        if self.vargs["csv"]:
+            return self.FORMAT_CSV
+        if self.vargs["json"]:
+            return self.FORMAT_JSON
+        if self.vargs["ndjson"]:
+            return self.FORMAT_NDJSON
+        if self.vargs["raw"] and (not listing):
+            return self.FORMAT_RAW
+        return self.FORMAT_HUMAN
+
+    def json_string(self, obj):
+        """
+        Return the given object serialized as a one-line JSON string,
+        adding the ``source`` field, if set.
+        """
+        if self.source is not None:
+            obj["source"] = self.source
+        return export_kobo.json_string(obj)
+
+    def render_stats(self, output_format):
+        """
+        Yield the statistics of the items requested by the user,
+        overall, per book, and per month,
+        rendered in the given output format.
+
+        The statistics are computed by SQLite aggregates,
+        hence the items are not read one at a time.
+        """
+        names = [u"group", u"title", u"author", u"month"] + export_kobo.STATS_COLUMNS
+        if output_format == self.FORMAT_CSV:
+            yield tuple([n.upper() for n in names])
+        elif output_format not in [self.FORMAT_JSON, self.FORMAT_NDJSON]:
+            yield u"\t".join([n.upper() for n in names])
+        schema = self.schema()
+        filters = self.items_filters()
+        for group_by in [export_kobo.STATS_TOTAL, export_kobo.STATS_BOOK, export_kobo.STATS_MONTH]:
+            query, parameters = export_kobo.build_stats_query(group_by=group_by, schema=schema, **filters)
+            keys = export_kobo.STATS_KEYS[group_by]
+            for row in self.iter_query(query, parameters):
+                values = collections.OrderedDict([(u"group", group_by)])
+                values.update(zip(keys, row[:len(keys)]))
+                values.update(zip(export_kobo.STATS_COLUMNS, row[len(keys):]))
+                if values[u"avg_highlight_length"] is not None:
+                    values[u"avg_highlight_length"] = round(values[u"avg_highlight_length"], 1)
+                if output_format in [self.FORMAT_JSON, self.FORMAT_NDJSON]:
+                    if self.source is not None:
+                        values[u"source"] = self.source
+                    yield self.json_string(values)
+                else:
+                    row = [values.get(n) for n in names]
+                    if output_format == self.FORMAT_CSV:
+                        yield tuple(row)
+                    else:
+                        yield u"\t".join([(u"" if v is None else u"%s" % v) for v in row])
+
+    def render_parallel(self, render, items):
+        """
+        Yield ``render(item)`` for each of the given Item objects, in order,
+        rendering chunks of ``JOBS_CHUNK_SIZE`` items
+        in a pool of ``--jobs`` worker processes.
+
+        The items are read in this process,
+        and at most two chunks per worker are in flight,
+        hence the memory used does not grow with the number of items.
+        If there are fewer than ``JOBS_MIN_ITEMS`` items,
+        or a single CPU, they are rendered in this process,
+        without starting the pool.
+        The number of workers is at most the number of CPUs.
+        """
+        items = iter(items)
+        head = list(itertools.islice(items, self.JOBS_MIN_ITEMS))
+        jobs = 1
+        if len(head) == self.JOBS_MIN_ITEMS:
+            import multiprocessing
+            jobs = min(self.vargs["jobs"], multiprocessing.cpu_count())
+        items = itertools.chain(head, items)
+        if jobs < 2:
+            # a small export, or a single CPU
+            if self.timings is not None:
+                rendered = self.timings.timed_map(render, items, "render")
+            else:
+                rendered = (render(i) for i in items)
+            for string in rendered:
+                yield string
+            return
+
+        pool = multiprocessing.Pool(jobs)
+        pending = collections.deque()
+        exhausted = False
+        try:
+            while True:
+                # NOTE: the items are read from the cursor in this thread,
+                #       as SQLite objects cannot be used by the feeder thread
+                #       of Pool.imap(), which would also read all of them at once
+                while (not exhausted) and (len(pending) < 2 * jobs):
+                    chunk = list(itertools.islice(items, self.JOBS_CHUNK_SIZE))
+                    if len(chunk) == 0:
+                        exhausted = True
+                    else:
+                        pending.append(pool.apply_async(render_chunk, (render, chunk)))
+                if len(pending) == 0:
+                    break
+                start = TIMER()
+                strings = pending.popleft().get()
+                if self.timings is not None:
+                    self.timings.add("render", TIMER() - start, len(strings))
+                for string in strings:
+                    yield string
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def iter_json_array(self, strings):
+        """
+        Yield the lines of a JSON array containing the given JSON strings,
+        one per line, as soon as they are produced.
+        """
+        yield u"["
+        previous = None
+        for string in strings:
+            if previous is not None:
+                yield previous + u","
+            previous = string
+        if previous is not None:
+            yield previous
+        yield u"]"
+
+    def export_cached(self, f):
+        """
+        As ``export()``, but reuse the output cached in the ``--cache`` directory
+        if the SQLite file has not changed since it was cached,
+        without querying the SQLite file at all.
+
+        The SQLite file is deemed unchanged if its size and mtime match
+        the cached ones, or, if only its mtime differs,
+        if the hash of its contents matches the cached one.
+
+        The cache is not used by ``--incremental``,
+        nor if ``--since`` or ``--until`` is a number of days.
+        """
+        cache_dir = self.vargs["cache"]
+        # NOTE: a relative date, e.g. 7d, depends on the current time,
+        #       hence its output would be cached under a new key on each run
+        if (cache_dir is None) or (self.vargs["incremental"] is not None) or self.relative_dates():
+            self.export(f)
+            return
+        import json
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                self.error(u"Unable to create the cache directory '%s'." % cache_dir)
+        db_path = self.vargs["db"]
+        if not os.path.exists(db_path):
+            self.error(u"Unable to read the KoboReader.sqlite file. Please check that the path is correct and that you have read permission on it.")
+        key = self.cache_key()
+        meta_path = os.path.join(cache_dir, key + u".json")
+        output_path = os.path.join(cache_dir, key + u".out")
+        meta = None
+        try:
+            with io.open(meta_path, "r", encoding="utf-8") as m:
+                meta = json.load(m)
+        except (IOError, ValueError):
+            pass
+
+        unchanged, stat, digest = self.fingerprint(db_path, meta)
+        if unchanged and os.path.exists(output_path):
+            # reuse the cached output
+            with io.open(output_path, "r", encoding="utf-8", newline="") as c:
+                while True:
+                    block = c.read(65536)
+                    if not block:
+                        break
+                    self.write_string(f, block)
+            self.items_count = meta["items_count"]
+            self.cached_books_count = meta["books_count"]
+            if meta["mtime"] != stat.st_mtime:
+                meta["mtime"] = stat.st_mtime
+                self.write_cache_meta(meta_path, meta)
+            return
+
+        # export, while writing a copy of the output to the cache
+        temp_path = output_path + u".tmp"
+        with io.open(temp_path, "w", encoding="utf-8", newline="") as c:
+            self.export(TeeFile(f, c))
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        os.rename(temp_path, output_path)
+        if digest is None:
+            digest = self.hash_file(db_path)
+        meta = {
+            "path": os.path.abspath(db_path),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "hash": digest,
+            "items_count": self.items_count,
+            "books_count": self.books_count(),
+        }
+        self.write_cache_meta(meta_path, meta)
+
+    def cache_key(self):
+        """
+        Return the name of the cache entry for the current SQLite file
+        and the current output options.
+
+        Only the output format and the ``CACHE_OPTIONS`` are part of the key,
+        hence options such as ``--timings`` or ``--jobs`` reuse the same entry.
+        """
+        import hashlib
+        import json
+        options = [(u"format", self.output_format())] + [(k, self.vargs[k]) for k in self.CACHE_OPTIONS]
+        key = json.dumps([os.path.abspath(self.vargs["db"]), self.source, options])
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def fingerprint(self, db_path, meta):
+        """
+        Compare the given SQLite file with the given cached metadata.
+
+        Return a tuple ``(unchanged, stat, digest)``,
+        where ``digest`` is the hash of the SQLite file,
+        or ``None`` if it was not computed.
+        """
+        stat = os.stat(db_path)
+        wal_path = db_path + u"-wal"
+        if os.path.exists(wal_path) and (os.path.getsize(wal_path) > 0):
+            # uncheckpointed changes, not covered by the fingerprint
+            return (False, stat, None)
+        if (meta is None) or (meta["size"] != stat.st_size):
+            return (False, stat, None)
+        if meta["mtime"] == stat.st_mtime:
+            return (True, stat, meta["hash"])
+        digest = self.hash_file(db_path)
+        return ((digest == meta["hash"]), stat, digest)
+
+    def hash_file(self, path):
+        """
+        Return the SHA-1 hash of the contents of the given file,
+        that is, the SQLite header and all the pages.
+        """
+        import hashlib
+        digest = hashlib.sha1()
+        with io.open(path, "rb") as f:
+            while True:
+                block = f.read(1048576)
+                if not block:
+                    break
+                digest.update(block)
+        return digest.hexdigest()
+
+    def write_cache_meta(self, meta_path, meta):
+        """
+        Write the metadata of a cache entry.
+        """
+        import json
+        try:
+            with io.open(meta_path, "w", encoding="utf-8") as m:
+                m.write(u"%s" % json.dumps(meta, sort_keys=True))
+        except IOError:
+            self.error(u"Unable to write the cache file '%s'." % meta_path)
+
+    def books_count(self):
+        """
+        Return the number of books with annotations or highlights.
+        """
+        if self.cached_books_count is not None:
+            return self.cached_books_count
+        if self.books is not None:
+            return len(self.books)
+        # NOTE: counted by SQLite, without creating the Book objects
+        return self.query(self.schema().query_books_count)[0][0]
+
+    def find_databases(self):
+        """
+        Return the sorted list of paths of the SQLite files
+        if the ``db`` argument is a directory or a glob pattern,
+        or ``None`` if it is a (single) file path.
+        """
+        db_path = self.vargs["db"]
+        if os.path.isdir(db_path):
+            db_paths = []
+            for root, dirs, files in os.walk(db_path):
+                for name in files:
+                    if name.endswith(u".sqlite"):
+                        db_paths.append(os.path.join(root, name))
+        elif (not os.path.exists(db_path)) and any([(c in db_path) for c in u"*?["]):
+            import glob
+            db_paths = [p for p in glob.glob(db_path) if os.path.isfile(p)]
+        else:
+            return None
+        if len(db_paths) == 0:
+            self.error(u"No SQLite files found in '%s'." % db_path)
+        return sorted(db_paths)
+
+    def export_fleet(self, db_paths):
+        """
+        Export the given SQLite files, using a pool of worker processes.
+
+        The output goes either to one file per SQLite file, in ``--output-dir``,
+        or to a single merged output, where each part is tagged with its SQLite file.
+        A failure in one SQLite file does not abort the export of the others.
+        """
+        import multiprocessing
+        output_dir = self.vargs["output_dir"]
+        if (output_dir is not None) and (self.vargs["output"] is not None):
+            self.error(u"You cannot specify both --output and --output-dir.")
+        if (output_dir is None) and (self.output_format() == self.FORMAT_JSON) and (len(db_paths) > 1):
+            self.error(u"You cannot merge several JSON outputs, please use --ndjson or --output-dir instead.")
+        if self.vargs["device"] is not None:
+            self.error(u"You cannot specify --device when exporting several SQLite files.")
+        if (output_dir is None) and (self.output_format() in [self.FORMAT_PARQUET, self.FORMAT_ARROW]) and (self.vargs["sqlite_out"] is None):
+            self.error(u"You cannot merge several columnar outputs, please use --output-dir instead.")
+        if (output_dir is not None) and (not os.path.isdir(output_dir)):
+            self.error(u"The output directory '%s' does not exist." % output_dir)
+        workers = self.vargs["workers"]
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        if workers < 1:
+            self.error(u"The number of workers must be a positive integer.")
+
+        databases = None
+        if self.vargs["incremental"] is not None:
+            databases = self.load_state()
+
+        merged = None
+        first = True
+        try:
+            if (output_dir is None) and (self.vargs["sqlite_out"] is None):
+                if self.vargs["output"] is not None:
+                    mode = "w"
+                    if (databases is not None) and (len(databases) > 0) and os.path.exists(self.vargs["output"]):
+                        mode = "a"
+                        first = False
+                    merged = io.open(self.vargs["output"], mode, encoding="utf-8")
+                else:
+                    merged = sys.stdout
+        except IOError:
+            self.error(u"Unable to write output file. Please check that the path is correct and that you have write permission on it.")
+
+        # NOTE: in a merged output, each worker writes its output
+        #       to a part file, copied into the merged output by this process,
+        #       hence the memory used does not grow with the size of the output
+        part_dir = None
+        if merged is not None:
+            import tempfile
+            part_dir = tempfile.mkdtemp(prefix=u"export-kobo-")
+
+        jobs = []
+        root = os.path.dirname(os.path.commonprefix(db_paths))
+        extension = self.output_extension()
+        for (index, db_path) in enumerate(db_paths):
+            vargs = dict(self.vargs)
+            vargs["db"] = db_path
+            vargs["output"] = None
+            source = None
+            part_path = None
+            if output_dir is not None:
+                name = os.path.splitext(os.path.relpath(db_path, root))[0]
+                name = name.replace(os.sep, u"_").replace(u"/", u"_")
+                vargs["output"] = os.path.join(output_dir, name + extension)
+            else:
+                source = db_path
+                if part_dir is not None:
+                    part_path = os.path.join(part_dir, u"%06d%s" % (index, extension))
+            state = None
+            if databases is not None:
+                state = databases.get(os.path.abspath(db_path))
+            jobs.append((vargs, source, state, part_path))
+
+        if (workers == 1) or (len(jobs) == 1):
+            results = (export_fleet_database(job) for job in jobs)
+            pool = None
+        else:
+            pool = multiprocessing.Pool(min(workers, len(jobs)))
+            results = pool.imap(export_fleet_database, jobs)
+
+        failures = 0
+        info = []
+        try:
+            for (db_path, message, part_path, books_count, items_count, state, deleted) in results:
+                if message is not None:
+                    failures += 1
+                    self.print_stderr(u"ERROR: %s: %s" % (db_path, message))
+                    continue
+                if merged is not None:
+                    if (not first) and (self.output_format() not in [self.FORMAT_CSV, self.FORMAT_NDJSON]):
+                        self.write_string(merged, u"\n")
+                    self.copy_part(merged, part_path)
+                    first = False
+                info.append((db_path, books_count, items_count))
+                if databases is not None:
+                    databases[os.path.abspath(db_path)] = state
+                    self.report_deleted(deleted, db_path)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            if (merged is not None) and (merged is not sys.stdout):
+                merged.close()
+            if part_dir is not None:
+                import shutil
+                shutil.rmtree(part_dir, ignore_errors=True)
+        if (merged is sys.stdout) and (self.output_format() != self.FORMAT_NDJSON):
+            self.write_string(sys.stdout, u"\n")
+
+        if databases is not None:
+            self.save_state(databases)
+
+        if self.vargs["info"]:
+            # print some info about the extraction
+            self.print_stdout(u"")
+            for (db_path, books_count, items_count) in info:
+                self.print_stdout(u"%s" % db_path)
+                self.print_stdout(u"  Books with annotations or highlights: %d" % books_count)
+                if not self.vargs["list"]:
+                    self.print_stdout(u"  Annotations and/or highlights:        %d" % items_count)
+            self.print_stdout(u"SQLite files exported: %d" % (len(db_paths) - failures))
+
+        if failures > 0:
+            self.error(u"Unable to export %d of %d SQLite files." % (failures, len(db_paths)))
+
+    def write_chunks(self, f, chunks, append=False):
+        """
+        Write the given strings to the given file object,
+        separated by a newline, as soon as they are produced.
+
+        If ``append`` is ``True``, a newline is written
+        before the first string as well.
+        """
+        first = not append
+        for chunk in chunks:
+            if not first:
+                self.write_string(f, u"\n")
+            self.write_string(f, chunk)
+            first = False
+
+    def copy_part(self, f, part_path):
+        """
+        Copy the given part file of a merged output to the given file object,
+        in blocks, and remove it.
+        """
+        try:
+            with io.open(part_path, "r", encoding="utf-8", newline="") as part:
+                while True:
+                    block = part.read(65536)
+                    if not block:
+                        break
+                    self.write_string(f, block)
+            os.remove(part_path)
+        except (IOError, OSError) as exc:
+            self.error(u"Unable to read the temporary file '%s': %s" % (part_path, exc))
+
+    def write_lines(self, f, lines):
+        """
+        Write the given strings to the given file object,
+        each followed by a newline, as soon as they are produced.
+        """
+        for line in lines:
+            self.write_string(f, line + u"\n")
+
+    def write_string(self, f, string):
+        """
+        Write the given string to the given file object,
+        replacing the characters that cannot be encoded, if needed.
+        """
+        try:
+            f.write(string)
+        except UnicodeEncodeError:
+            string = string.encode("ascii", errors="replace")
+            if not PY2:
+                # PY3
+                string = string.decode("ascii")
+            f.write(string)
+
+    def enumerate_books(self):
+        """
+        Return a list of pairs ``(int, Book)``,
+        with the index starting at one.
+
+        The list is computed once per run, and then cached.
+        """
+        if self.books is None:
+            books = self.query(self.schema().query_books, factory=Book)
+            self.books = list(enumerate(books, start=1))
+        return self.books
+
+    def volumeid_from_bookid(self):
+        """
+        Get the correct ``volumeid`` from the ``bookid``,
+        that is, the index of the book
+        as produced by the ``enumerate_books()``.
+
+        The ``volumeid`` is resolved once per run, and then cached.
+        """
+        if self.volumeid is None:
+            enum = self.enumerate_books()
+            bookid = self.vargs["bookid"]
+            try:
+                self.volumeid = enum[int(bookid) - 1][1].volumeid
+            except:
+                self.error(u"The bookid value must be an integer between 1 and %d" % (len(enum)))
+        return self.volumeid
+
+    def items_query_arguments(self, order_by_book=False):
+        """
+        Return the keyword arguments of ``export_kobo.iter_items()``
+        selecting the Item rows requested by the user:
+        the filters ``--book``, ``--bookid``, ``--highlights-only``, ``--annotations-only``,
+        ``--since`` and ``--until``, and the order ``--sort``, ``--limit`` and ``--offset``.
+
+        If ``order_by_book`` is ``True``, the rows of each book are contiguous.
+        """
+        modified_since = None
+        if self.state is not None:
+            # incremental export: rows with a NULL DateModified
+            # are checked against the known bookmark IDs in iter_items()
+            modified_since = self.state["datemodified"]
+        arguments = self.items_filters()
+        arguments.update({
+            "modified_since": modified_since,
+            "order_by_book": order_by_book,
+            "sort": self.vargs["sort"],
+            "reverse": self.vargs["reverse"],
+            "limit": self.vargs["limit"],
+            "offset": self.vargs["offset"],
+        })
+        return arguments
+
+    def date_bound(self, option):
+        """
+        Return the date given with ``--since`` or ``--until``
+        as an ISO string, comparable with the ``DateCreated`` strings,
+        or ``None`` if not given.
+
+        A number of days, e.g. ``7d``, is converted
+        into the date that many days ago (UTC).
+        """
+        import datetime
+        value = self.vargs[option]
+        if value is None:
+            return None
+        match = re.match(self.RELATIVE_DATE, value)
+        if match is not None:
+            date = datetime.datetime.utcnow() - datetime.timedelta(days=int(match.group(1)))
+            return date.strftime("%Y-%m-%dT%H:%M:%S")
+        if re.match(r"^[0-9]{4}-[0-9]{2}-[0-9]{2}([T ][0-9]{2}:[0-9]{2}(:[0-9]{2}(\.[0-9]+)?)?)?$", value) is None:
+            self.error(u"Invalid --%s date '%s', please use YYYY-MM-DD, YYYY-MM-DDTHH:MM:SS, or a number of days (e.g., 7d)." % (option, value))
+        return value.replace(u" ", u"T")
+
+    def relative_dates(self):
+        """
+        Return ``True`` if ``--since`` or ``--until``
+        is given as a number of days, e.g. ``7d``.
+        """
+        for option in [u"since", u"until"]:
+            if (self.vargs[option] is not None) and (re.match(self.RELATIVE_DATE, self.vargs[option]) is not None):
+                return True
+        return False
+
+    def items_filters(self):
+        """
+        Translate the filters requested by the user into
+        a dictionary with keys ``volumeid``, ``title``, ``kind``, ``since`` and ``until``,
+        to be passed to ``export_kobo.build_items_filters()``.
+        """
+        if (self.vargs["bookid"] is not None) and (self.vargs["book"] is not None):
+            self.error(u"You cannot specify both --book and --bookid.")
+        if self.vargs["highlights_only"] and self.vargs["annotations_only"]:
+            self.error(u"You cannot specify both --highlights-only and --annotations-only.")
+        kind = None
+        if self.vargs["highlights_only"]:
+            kind = Item.HIGHLIGHT
+        if self.vargs["annotations_only"]:
+            kind = Item.ANNOTATION
+        return {
+            "volumeid": self.volumeid_from_bookid() if self.vargs["bookid"] is not None else None,
+            "title": self.vargs["book"],
+            "kind": kind,
+            "since": self.date_bound("since"),
+            "until": self.date_bound("until"),
+        }
+
+    def build_search_query(self, order_by_book=False):
+        """
+        Build the query selecting, from the full-text search index,
+        the Item rows matching the ``--search`` query
+        and the other filters requested by the user,
+        best matches first, unless ``--sort`` is specified.
+
+        Return a pair ``(query, parameters)``.
+
+        If ``order_by_book`` is ``True``, the rows of each book are contiguous,
+        and best matches come first within each book.
+        """
+        clauses, parameters = export_kobo.build_items_filters(self.SEARCH_COLUMNS, **self.items_filters())
+        clauses.insert(0, u"items_fts MATCH ?")
+        parameters.insert(0, self.vargs["search"])
+        limit = self.vargs["limit"]
+        offset = self.vargs["offset"]
+        if order_by_book and ((limit is not None) or (offset is not None)):
+            # NOTE: select the page of the best matches first,
+            #       otherwise the page would be taken from the matches grouped by book
+            page, page_parameters = export_kobo.build_items_page(
+                u"items.rowid",
+                self.QUERY_SEARCH_ROWIDS,
+                self.SEARCH_COLUMNS,
+                clauses,
+                parameters,
+                sort=self.vargs["sort"],
+                reverse=self.vargs["reverse"],
+                tiebreak=u"rank",
+                limit=limit,
+                offset=offset
+            )
+            clauses = clauses + [page]
+            parameters = parameters + page_parameters
+            limit = None
+            offset = None
+        order, order_parameters = export_kobo.build_items_order(
+            self.SEARCH_COLUMNS,
+            order_by=([u"items.VolumeID"] if order_by_book else []),
+            sort=self.vargs["sort"],
+            reverse=self.vargs["reverse"],
+            tiebreak=u"rank",
+            limit=limit,
+            offset=offset
+        )
+        query = self.QUERY_SEARCH + u" WHERE " + u" AND ".join(clauses) + order + u";"
+        return (query, tuple(parameters + order_parameters))
+
+    def iter_items(self, order_by_book=False):
+        """
+        Query the SQLite file, yielding one at a time
+        the Item objects requested by the user.
+
+        The number of yielded items is stored in ``items_count``.
+        If ``order_by_book`` is ``True``, the items of each book are contiguous.
+
+        In an incremental export, only the items that are new,
+        or that were modified after the last run, are yielded.
+        If ``--search`` is specified, the items are read
+        from the full-text search index instead.
+        """
+        if self.vargs["search"] is not None:
+            sql_connection = self.connect_search_index()
+            query, parameters = self.build_search_query(order_by_book)
+            items = self.iter_query(query, parameters, factory=Item, sql_connection=sql_connection)
+        else:
+            items = self.iter_query_rows(export_kobo.iter_items(
+                self.connect(),
+                schema=self.schema(),
+                timings=self.timings,
+                **self.items_query_arguments(order_by_book)
+            ))
+        self.items_count = 0
+        self.exported = None
+        known = None
+        if self.state is not None:
+            known = self.state["bookmarkids"]
+            # NOTE: without a max DateModified, e.g. if all the values are NULL,
+            #       or on old firmwares without the column,
+            #       the known rows are skipped by their bookmark ID only,
+            #       as their DateModified is read as Item.NO_DATE
+            mark = self.state["datemodified"]
+            if mark is None:
+                mark = Item.NO_DATE
+            # the bookmark IDs and the max DateModified of the exported items,
+            # used by update_state()
+            self.exported = (set(), [self.state["datemodified"]])
+        for item in items:
+            if known is not None:
+                if (item.bookmarkid in known) and (not item.datemodified > mark):
+                    continue
+                self.exported[0].add(item.bookmarkid)
+                if (item.datemodified != Item.NO_DATE) and ((self.exported[1][0] is None) or (item.datemodified > self.exported[1][0])):
+                    self.exported[1][0] = item.datemodified
+            self.items_count += 1
+            yield item
+
+    def load_state(self):
+        """
+        Load the incremental export state file,
+        returning a dictionary with one entry per SQLite file,
+        or an empty dictionary if the state file does not exist yet.
+        """
+        import json
+        state_path = self.vargs["incremental"]
+        if not os.path.exists(state_path):
+            return {}
+        try:
+            with io.open(state_path, "r", encoding="utf-8") as f:
+                return json.load(f)["databases"]
+        except (IOError, ValueError, KeyError) as exc:
+            self.error(u"Unable to read the state file '%s': %s" % (state_path, exc))
+
+    def save_state(self, databases):
+        """
+        Save the incremental export state file.
+        """
+        import json
+        state_path = self.vargs["incremental"]
+        try:
+            with io.open(state_path, "w", encoding="utf-8") as f:
+                f.write(u"%s" % json.dumps({"version": 1, "databases": databases}, sort_keys=True))
+        except IOError as exc:
+            self.error(u"Unable to write the state file '%s': %s" % (state_path, exc))
+
+    def set_state(self, state):
+        """
+        Set the incremental export state of the current SQLite file,
+        as loaded from the state file (``None`` on the first run).
+
+        If the output file already exists, the new items are appended to it.
+        """
+        self.state = None
+        self.append = False
+        if state is not None:
+            self.state = {
+                "datemodified": state["datemodified"],
+                "bookmarkids": set(state["bookmarkids"]),
+            }
+            output = self.vargs["output"]
+            self.append = (output is not None) and os.path.exists(output)
+
+    def state_key(self):
+        """
+        Return the key identifying the current SQLite file in the state file.
+        """
+        return os.path.abspath(self.vargs["db"])
+
+    def update_state(self):
+        """
+        Compute the incremental export state of the current SQLite file,
+        after exporting it.
+
+        Return a pair ``(state, deleted)``, where ``state`` contains
+        the max ``DateModified`` and the list of known bookmark IDs,
+        and ``deleted`` is the sorted list of the bookmark IDs
+        deleted since the last run.
+
+        If all the new or modified items were exported,
+        and the number of rows shows that none was deleted,
+        the state is computed from the exported items,
+        without reading the whole Bookmark table again.
+        As for the incremental query, new rows are assumed
+        not to be older than the previous export.
+        """
+        if (
+            (self.exported is not None) and
+            (self.vargs["search"] is None) and
+            all([(v is None) for v in self.items_filters().values()])
+        ):
+            current = self.state["bookmarkids"] | self.exported[0]
+            if self.query(self.QUERY_COUNT)[0][0] == len(current):
+                state = {
+                    "datemodified": self.exported[1][0],
+                    "bookmarkids": sorted(current),
+                }
+                return (state, [])
+        schema = self.schema()
+        current = set([d[0] for d in self.query(schema.query_bookmark_ids)])
+        datemodified = self.query(schema.query_max_datemodified)[0][0]
+        deleted = []
+        if self.state is not None:
+            deleted = sorted(self.state["bookmarkids"] - current)
+        state = {
+            "datemodified": datemodified,
+            "bookmarkids": sorted(current),
+        }
+        return (state, deleted)
+
+    def report_deleted(self, deleted, db_path=None):
+        """
+        Report the bookmark IDs deleted since the last run on standard error.
+        """
+        for bookmarkid in deleted:
+            if db_path is None:
+                self.print_stderr(u"Deleted: %s" % bookmarkid)
+            else:
+                self.print_stderr(u"Deleted: %s: %s" % (db_path, bookmarkid))
+
+    def connect(self):
+        """
+        Open a read-only connection to the SQLite file,
+        or return the one already open.
+
+        The connection is opened once per run,
+        and it is reused by all the queries.
+        """
+        if self.sql_connection is not None:
+            return self.sql_connection
+        start = TIMER()
+        try:
+            sql_connection = export_kobo.open_db(
+                self.vargs["db"],
+                immutable=self.vargs["immutable"],
+                mmap_size=self.vargs["mmap_size"],
+                cache_size=self.vargs["cache_size"]
+            )
+        except KoboError as exc:
+            self.error(u"%s" % exc)
+        if self.timings is not None:
+            self.timings.add("open", TIMER() - start, 1)
+        if self.snapshotting():
+            sql_connection = self.snapshot(sql_connection)
+        self.sql_connection = sql_connection
+        return self.sql_connection
+
+    def snapshotting(self):
+        """
+        Return ``True`` if the SQLite file must be copied
+        before running the queries.
+        """
+        return self.vargs["snapshot"] or (self.vargs["snapshot_dir"] is not None)
+
+    def snapshot(self, sql_connection):
+        """
+        Copy the SQLite file open in the given connection
+        into memory, or into a temporary file in ``--snapshot-dir``,
+        close the given connection, and return a connection to the copy.
+
+        The progress is printed to standard error, if ``--info`` is specified.
+        """
+        start = TIMER()
+        path = u":memory:"
+        if self.vargs["snapshot_dir"] is not None:
+            import tempfile
+            try:
+                handle, path = tempfile.mkstemp(suffix=u".sqlite", dir=self.vargs["snapshot_dir"])
+                os.close(handle)
+            except (IOError, OSError) as exc:
+                sql_connection.close()
+                self.error(u"Unable to create a temporary file in '%s': %s" % (self.vargs["snapshot_dir"], exc))
+            self.snapshot_path = path
+
+        def progress(copied, total):
+            self.print_stderr(u"Copied %d/%d pages" % (copied, total))
+
+        try:
+            snapshot = export_kobo.snapshot_db(
+                sql_connection,
+                path=path,
+                pages=self.vargs["snapshot_pages"],
+                progress=(progress if self.vargs["info"] else None)
+            )
+        except KoboError as exc:
+            self.error(u"%s" % exc)
+        finally:
+            # NOTE: release the SQLite file as soon as possible
+            sql_connection.close()
+        if self.snapshot_path is not None:
+            for pragma in ["mmap_size", "cache_size"]:
+                if self.vargs[pragma] is not None:
+                    snapshot.execute(u"PRAGMA %s = %d;" % (pragma, self.vargs[pragma]))
+        if self.timings is not None:
+            pages = snapshot.execute(u"PRAGMA page_count;").fetchone()[0]
+            page_size = snapshot.execute(u"PRAGMA page_size;").fetchone()[0]
+            self.timings.add("snapshot", TIMER() - start, pages, pages * page_size)
+        return snapshot
+
+    def schema(self):
+        """
+        Return the Schema of the SQLite file,
+        detected once per connection.
+        """
+        if self.sql_schema is None:
+            try:
+                self.sql_schema = export_kobo.detect_schema(self.connect())
+            except KoboError as exc:
+                self.error(u"%s" % exc)
+        return self.sql_schema
+
+    def close(self):
+        """
+        Close the connection to the SQLite file, if open,
+        and remove its temporary copy, if any.
+        """
+        if self.sql_connection is not None:
+            self.sql_connection.close()
+            self.sql_connection = None
+        self.sql_schema = None
+        if self.snapshot_path is not None:
+            try:
+                os.remove(self.snapshot_path)
+            except OSError:
+                pass
+            self.snapshot_path = None
+        if self.search_connection is not None:
+            self.search_connection.close()
+            self.search_connection = None
+
+    def connect_search_index(self):
+        """
+        Open a connection to the full-text search index,
+        or return the one already open.
+
+        The index is (re)built if it does not exist yet,
+        or if the SQLite file has changed since it was built.
+        """
+        import json
+        if self.search_connection is not None:
+            return self.search_connection
+        db_path = self.vargs["db"]
+        if not os.path.exists(db_path):
+            self.error(u"Unable to read the KoboReader.sqlite file. Please check that the path is correct and that you have read permission on it.")
+        index_path = self.vargs["search_index"]
+        if index_path is None:
+            index_path = db_path + u".fts"
+        meta = None
+        if os.path.exists(index_path):
+            try:
+                sql_connection = sqlite3.connect(index_path)
+                meta = json.loads(sql_connection.execute(self.QUERY_SEARCH_META).fetchone()[0])
+                sql_connection.close()
+            except (sqlite3.Error, TypeError, ValueError):
+                meta = None
+        unchanged, stat, digest = self.fingerprint(db_path, meta)
+        if not unchanged:
+            if digest is None:
+                digest = self.hash_file(db_path)
+            meta = {
+                "path": os.path.abspath(db_path),
+                "size": stat.st_size,
+                "mtime": stat.st_mtime,
+                "hash": digest,
+            }
+            self.build_search_index(index_path, meta)
+        try:
+            self.search_connection = sqlite3.connect(index_path)
+        except sqlite3.Error as exc:
+            self.error(u"Unable to open the search index '%s': %s" % (index_path, exc))
+        return self.search_connection
+
+    def build_search_index(self, index_path, meta):
+        """
+        Build the full-text search index at the given path,
+        storing the given metadata about the SQLite file.
+
+        The index is built into a temporary file,
+        which then replaces the old index, if any.
+        """
+        import json
+        temp_path = index_path + u".tmp"
+        try:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            sql_connection = sqlite3.connect(temp_path)
+            try:
+                sql_connection.executescript(self.SCRIPT_SEARCH_INDEX)
+            except sqlite3.OperationalError as exc:
+                sql_connection.close()
+                self.error(u"Unable to create the search index, your SQLite library might lack FTS5 support: %s" % (exc))
+            sql_connection.executemany(
+                u"INSERT INTO items VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);",
+                self.iter_query(self.schema().query_items + u";")
+            )
+            sql_connection.execute(u"INSERT INTO items_fts(items_fts) VALUES ('rebuild');")
+            sql_connection.execute(u"INSERT INTO meta VALUES ('source', ?);", (json.dumps(meta),))
+            sql_connection.commit()
+            sql_connection.close()
+            if os.path.exists(index_path):
+                os.remove(index_path)
+            os.rename(temp_path, index_path)
+        except (IOError, OSError, sqlite3.Error) as exc:
+            self.error(u"Unable to write the search index '%s': %s" % (index_path, exc))
+
+    def query(self, query, parameters=(), factory=None):
+        """
+        Run the given query over the SQLite file,
+        binding the given parameters,
+        and return the list of the resulting rows.
+
+        If ``factory`` is not ``None``, each row is converted
+        by calling ``factory(row)`` directly in the SQLite row factory.
+        """
+        # NOTE the values are Unicode strings (unicode on PY2, str on PY3)
+        #      hence the result is a list of tuples of Unicode strings,
+        #      or a list of factory objects
+        return list(self.iter_query(query, parameters, factory))
+
+    def iter_query(self, query, parameters=(), factory=None, sql_connection=None):
+        """
+        Run the given query over the SQLite file,
+        or over the given connection,
+        binding the given parameters,
+        and yield the resulting rows lazily from the cursor,
+        with ``export_kobo.iter_query()``.
+
+        If ``factory`` is not ``None``, each row is converted
+        by calling ``factory(row)`` directly in the SQLite row factory.
+        """
+        if sql_connection is None:
+            sql_connection = self.connect()
+        return self.iter_query_rows(export_kobo.iter_query(sql_connection, query, parameters, factory=factory, timings=self.timings))
+
+    def iter_query_rows(self, rows):
+        """
+        Yield the rows read by the given generator of ``export_kobo``,
+        exiting with an error message if reading fails.
+        """
+        try:
+            for row in rows:
+                yield row
+        except KoboError as exc:
+            self.error(u"%s" % exc)
+
+
+def export_fleet_database(job):
+    """
+    Export one SQLite file of a fleet export.
+
+    This function runs in a worker process, hence it is defined
+    at module level, and it never exits:
+    errors are returned to the caller instead.
+
+    Return a tuple ``(db_path, error_message, part_path, books_count, items_count, state, deleted)``,
+    where ``part_path`` is the file containing the output, if it is merged,
+    and ``state`` and ``deleted`` are the results of ``update_state()``
+    in an incremental export.
+    """
+    vargs, source, state, part_path = job
+    db_path = vargs["db"]
+    tool = ExportKobo()
+    tool.vargs = vargs
+    tool.source = source
+    tool.raise_errors = True
+    books_count = 0
+    deleted = []
+    message = None
+    # NOTE: the output file of an incremental export might exist already,
+    #       and be appended to, hence it is removed on failure
+    #       only if it was created or truncated by this export
+    created = (vargs["output"] is not None) and (not os.path.exists(vargs["output"]))
+    try:
+        if vargs["incremental"] is not None:
+            tool.set_state(state)
+        if vargs["sqlite_out"] is not None:
+            tool.export_archive(vargs["sqlite_out"])
+        elif tool.output_format() in [tool.FORMAT_PARQUET, tool.FORMAT_ARROW]:
+            tool.export_columnar(vargs["output"])
+        elif vargs["output"] is not None:
+            mode = "a" if tool.append else "w"
+            created = created or (mode == "w")
+            try:
+                with io.open(vargs["output"], mode, encoding="utf-8") as f:
+                    tool.export_cached(f)
+            except IOError:
+                tool.error(u"Unable to write output file '%s'." % vargs["output"])
+        elif part_path is not None:
+            # NOTE: copied into the merged output by the parent process
+            try:
+                with io.open(part_path, "w", encoding="utf-8", newline="") as f:
+                    tool.export_cached(f)
+            except IOError:
+                tool.error(u"Unable to write the temporary file '%s'." % part_path)
+        if vargs["incremental"] is not None:
+            state, deleted = tool.update_state()
+        if vargs["info"]:
+            books_count = tool.books_count()
+    except CommandLineToolError as exc:
+        message = u"%s" % exc
+    except Exception as exc:
+        message = u"Unexpected error: %s" % exc
+    finally:
+        tool.close()
+    if message is not None:
+        # NOTE: do not leave a partial output file of a failed SQLite file
+        #       in --output-dir
+        if created and os.path.exists(vargs["output"]):
+            try:
+                os.remove(vargs["output"])
+            except OSError:
+                pass
+        return (db_path, message, None, 0, 0, state, [])
+    return (db_path, None, part_path, books_count, tool.items_count, state, deleted)
+
+
+def render_chunk(render, items):
+    """
+    Return the list of ``render(item)`` for the given Item objects.
+
+    This function runs in a worker process of ``--jobs``,
+    hence it is defined at module level.
+    """
+    return [render(i) for i in items]
+
+
+def main():
+    ExportKobo().run()
+
+
+if __name__ == "__main__":
+    main()